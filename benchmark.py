@@ -0,0 +1,302 @@
+""" Loopback swarm benchmark
+
+Generates a random payload and its metainfo, starts seeders and leechers in
+their own processes, lets the leechers download over 127.0.0.1 and reports
+throughput, CPU time per MB, main loop latency and memory use. A few
+microbenchmarks for the message parser, File and the piece picker are run
+first, unless --no-micro is given.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+from bencode import bencode
+from file import File, BLOCKSIZE
+from maketorrent import make_torrent
+from peer import Peer, Request
+from picker import PiecePicker
+import torrent
+from workers import Coordinator
+
+MB = 1024 * 1024
+
+
+def make_payload(directory, name, size, piece_size):
+    """ Writes a random payload, returns the path of its .torrent file """
+    with open(os.path.join(directory, name), "wb") as payload:
+        payload.write(os.urandom(size))
+
+    metainfo = make_torrent(os.path.join(directory, name),
+                            piece_size=piece_size)
+    path = os.path.join(directory, name + ".torrent")
+    with open(path, "wb") as tr_file:
+        tr_file.write(bencode(metainfo))
+
+    return path
+
+
+def _cpu_time():
+    # Children are the worker processes, if any
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime +
+            children.ru_utime + children.ru_stime)
+
+
+def _node(directory, torrent_path, index, seeding, workers, ports, swarm,
+          results):
+    os.chdir(directory)
+    # The client is chatty, and the terminal would be the bottleneck
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+    tr = torrent.Torrent(torrent_path)
+    tr.peer_id = ("-PY0000-bench%07d" % index).encode()
+    if seeding:
+        tr.file.verify()
+    ports.put((index, tr.listen(host="127.0.0.1")))
+
+    if seeding:
+        tr.mainloop(seed=True)
+        return
+
+    tr.swarm = set(swarm.get())
+    start = time.perf_counter()
+    cpu_start = _cpu_time()
+    if workers > 1:
+        Coordinator(tr, workers).run()
+    else:
+        tr.mainloop()
+    elapsed = time.perf_counter() - start
+    cpu = _cpu_time() - cpu_start
+
+    with open(tr.file.filename, "rb") as payload:
+        digest = hashlib.sha1(payload.read()).hexdigest()
+    results.put({"index": index, "elapsed": elapsed, "cpu": cpu,
+                 "digest": digest, "stats": tr.stats,
+                 "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def run_swarm(size, piece_size, num_seeders, num_leechers, timeout,
+              workers=1):
+    ctx = multiprocessing.get_context("fork")
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    processes = []
+    try:
+        torrent_path = make_payload(workdir, "payload.bin", size, piece_size)
+        with open(os.path.join(workdir, "payload.bin"), "rb") as payload:
+            expected = hashlib.sha1(payload.read()).hexdigest()
+
+        ports = ctx.Queue()
+        results = ctx.Queue()
+        swarms = []
+        for index in range(num_seeders + num_leechers):
+            seeding = index < num_seeders
+            directory = os.path.join(workdir, "node%d" % index)
+            os.mkdir(directory)
+            if seeding:
+                shutil.copy(os.path.join(workdir, "payload.bin"), directory)
+            swarm = ctx.Queue()
+            swarms.append(swarm)
+            process = ctx.Process(target=_node,
+                                  args=(directory, torrent_path, index,
+                                        seeding, workers, ports, swarm,
+                                        results))
+            process.start()
+            processes.append(process)
+
+        addresses = {}
+        for _ in processes:
+            (index, port) = ports.get(timeout=timeout)
+            addresses[index] = ("127.0.0.1", port)
+
+        # Leechers only connect to nodes started before them. When two nodes
+        # connect to each other at once, each may keep a different one of the
+        # two connections and drop the other as a duplicate, leaving neither
+        for index in range(num_seeders, num_seeders + num_leechers):
+            swarms[index].put([addresses[i] for i in range(index)])
+
+        leechers = []
+        for _ in range(num_leechers):
+            leechers.append(results.get(timeout=timeout))
+
+        for leecher in leechers:
+            if leecher["digest"] != expected:
+                raise RuntimeError("leecher %d got a corrupt payload" %
+                                   leecher["index"])
+        return leechers
+    finally:
+        # Not daemonic, leechers can have worker processes of their own
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(workdir)
+
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else float("inf")
+
+
+def bench_messages(num_blocks=2000):
+    """ Block messages per second through Peer.read_messages """
+    piece_size = 4 * BLOCKSIZE
+    pieces = b"\0" * 20 * ((num_blocks * BLOCKSIZE) // piece_size)
+    with tempfile.TemporaryDirectory() as directory:
+        file = File(os.path.join(directory, "messages.bin"),
+                    num_blocks * BLOCKSIZE, piece_size, pieces)
+        peer = Peer(None, ("127.0.0.1", 0), b"\0" * 20, file)
+        block = os.urandom(BLOCKSIZE)
+        messages = []
+        for i in range(num_blocks):
+            request = Request(i * BLOCKSIZE // piece_size,
+                              i * BLOCKSIZE % piece_size, BLOCKSIZE)
+            peer.request(request)
+            messages.append(struct.pack("!IBII", 1 + 4 + 4 + BLOCKSIZE, 7,
+                                        request.index, request.begin))
+            messages.append(block)
+        stream = b"".join(messages)
+
+        start = time.perf_counter()
+        for i in range(0, len(stream), torrent.BUFFER_SIZE):
+            peer.read_messages(stream[i:i + torrent.BUFFER_SIZE])
+        elapsed = time.perf_counter() - start
+        del peer, file
+
+    return {"blocks/s": _rate(num_blocks, elapsed),
+            "MB/s": _rate(num_blocks * BLOCKSIZE / MB, elapsed)}
+
+
+def bench_file(size=32 * MB, piece_size=256 * 1024):
+    """ Storing and verifying blocks """
+    data = os.urandom(size)
+    pieces = b"".join([hashlib.sha1(data[i:i + piece_size]).digest()
+                       for i in range(0, size, piece_size)])
+    with tempfile.TemporaryDirectory() as directory:
+        file = File(os.path.join(directory, "file.bin"), size, piece_size,
+                    pieces)
+        start = time.perf_counter()
+        for offset in range(0, size, BLOCKSIZE):
+            file.store_block(offset // piece_size, offset % piece_size,
+                             data[offset:offset + BLOCKSIZE])
+        elapsed = time.perf_counter() - start
+        assert file.is_complete()
+        del file
+
+    return {"MB/s": _rate(size / MB, elapsed)}
+
+
+def bench_picker(num_pieces=4096, num_peers=30, rounds=20):
+    """ Requests picked per second, with a loop's worth of peers """
+    pieces = b"\0" * 20 * num_pieces
+    with tempfile.TemporaryDirectory() as directory:
+        file = File(os.path.join(directory, "picker.bin"),
+                    num_pieces * 4 * BLOCKSIZE, 4 * BLOCKSIZE, pieces)
+        picker = PiecePicker(file)
+        peers = []
+        for i in range(num_peers):
+            peer = Peer(None, ("127.0.0.1", i), b"\0" * 20, file)
+            peer.state["has_pieces"][:num_pieces] = True
+            peers.append(peer)
+
+        picked = 0
+        start = time.perf_counter()
+        for _ in range(rounds):
+            picker.update(peers)
+            for peer in peers:
+                want = peer.state["has_pieces"] & ~file.get_bitfield()
+                while len(peer.state["out_requests"]) < torrent.MAX_OUT_REQUESTS:
+                    request = picker.next_request(peer, want)
+                    peer.request(request)
+                    picked += 1
+                # Pretend they all came back
+                peer.state["out_requests"] = []
+        elapsed = time.perf_counter() - start
+        del peers, picker, file
+
+    return {"requests/s": _rate(picked, elapsed)}
+
+
+def measure_memory(num_pieces=4096, num_peers=100):
+    """ Bytes of Python heap per piece (File and PiecePicker) and per peer """
+    pieces = b"\0" * 20 * num_pieces
+    with tempfile.TemporaryDirectory() as directory:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        file = File(os.path.join(directory, "memory.bin"),
+                    num_pieces * BLOCKSIZE, BLOCKSIZE, pieces)
+        picker = PiecePicker(file)
+        per_piece = (tracemalloc.get_traced_memory()[0] - before) / num_pieces
+
+        before = tracemalloc.get_traced_memory()[0]
+        peers = [Peer(None, ("127.0.0.1", i), b"\0" * 20, file)
+                 for i in range(num_peers)]
+        per_peer = (tracemalloc.get_traced_memory()[0] - before) / num_peers
+        tracemalloc.stop()
+        del peers, picker, file
+
+    return {"bytes/piece": per_piece, "bytes/peer": per_peer}
+
+
+def _print_section(title, values):
+    print("%-10s %s" % (title, "  ".join(["%s: %.4g" % item
+                                          for item in values.items()])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=64,
+                        help="payload size in MB")
+    parser.add_argument("--piece-size", type=int, default=256,
+                        help="piece size in kB")
+    parser.add_argument("--seeders", type=int, default=1)
+    parser.add_argument("--leechers", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes per leecher")
+    parser.add_argument("--timeout", type=int, default=300,
+                        help="give up after this many seconds")
+    parser.add_argument("--no-micro", action="store_true",
+                        help="skip the microbenchmarks")
+    args = parser.parse_args()
+
+    if not args.no_micro:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sections = [("messages", bench_messages()),
+                        ("file", bench_file()),
+                        ("picker", bench_picker()),
+                        ("memory", measure_memory())]
+        for title, values in sections:
+            _print_section(title, values)
+
+    size = args.size * MB
+    leechers = run_swarm(size, args.piece_size * 1024, args.seeders,
+                         args.leechers, args.timeout, args.workers)
+
+    for leecher in sorted(leechers, key=lambda l: l["index"]):
+        stats = leecher["stats"]
+        loops = max(stats["loops"], 1)
+        _print_section("leecher%d" % leecher["index"], {
+            "MB/s": _rate(size / MB, leecher["elapsed"]),
+            "CPU s/MB": leecher["cpu"] / (size / MB),
+            "loops": stats["loops"],
+            "mean loop ms": 1000 * stats["busy"] / loops,
+            "max loop ms": 1000 * stats["max_busy"],
+            "maxrss MB": leecher["maxrss"] / 1024})
+
+    total = sum([size for _ in leechers]) / MB
+    slowest = max([leecher["elapsed"] for leecher in leechers])
+    _print_section("swarm", {"MB/s": _rate(total, slowest)})
+
+
+if __name__ == "__main__":
+    random.seed()
+    main()
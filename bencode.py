@@ -43,13 +43,18 @@ def __bdecode(bytestring, start):
 
     return result, new_start
 
-def bdecode(bytestring):
-    """ Bdecodes a bytestring """
+def bdecode_prefix(bytestring):
+    """ Bdecodes the value at the start of a bytestring, and returns it along
+        with the offset where the trailing data starts """
     try:
-        out, end = __bdecode(bytestring, 0)
+        return __bdecode(bytestring, 0)
     except IndexError as e:
         raise ValueError("truncated bencoded bytestring") from e
 
+def bdecode(bytestring):
+    """ Bdecodes a bytestring """
+    out, end = bdecode_prefix(bytestring)
+
     if end < len(bytestring):
         raise ValueError("trailing data")
 
@@ -66,7 +71,8 @@ def bencode(obj):
     elif isinstance(obj, list):
         return b'l' + b''.join([bencode(o) for o in obj]) + b'e'
     elif isinstance(obj, dict):
+        # Keys have to be sorted, whatever order we built the dict in
         return b'd' + b''.join([bencode(key) + bencode(obj[key])
-                                for key in obj.keys()]) + b'e'
+                                for key in sorted(obj.keys())]) + b'e'
     else:
         raise TypeError("invalid type for bencoding: %s" % type(obj))
@@ -0,0 +1,485 @@
+""" Mainline DHT (BEP 5)
+
+A DHTNode owns a UDP socket and is driven from the outside, like the peers
+in Torrent.mainloop: call handle_read when the socket is readable and tick
+every once in a while. Lookups run iteratively, with at most ALPHA queries
+in flight, and report their latency and the number of messages they took.
+
+python dht.py runs a swarm of nodes on localhost and prints those metrics.
+"""
+import argparse
+import collections
+import hashlib
+import heapq
+import os
+import selectors
+import socket
+import struct
+import time
+from bencode import bdecode, bencode
+from tracker import decode_peers, encode_peers
+
+K = 8  # bucket size, and how many nodes a lookup converges on
+ALPHA = 3  # queries in flight per lookup
+QUERY_TIMEOUT = 2
+# Nodes that failed to answer this many queries in a row can be replaced
+MAX_FAILURES = 2
+# Tokens we hand out stay valid for two of these
+TOKEN_INTERVAL = 5 * 60
+PEER_TTL = 30 * 60
+MAX_PEERS_PER_HASH = 100
+MAX_INFO_HASHES = 1000
+MAX_DATAGRAM = 1500
+
+DEFAULT_BOOTSTRAP = [("router.bittorrent.com", 6881),
+                     ("dht.transmissionbt.com", 6881)]
+
+Transaction = collections.namedtuple("Transaction",
+                                     "query node_id address sent lookup")
+
+
+def distance(a, b):
+    return int.from_bytes(a, "big") ^ int.from_bytes(b, "big")
+
+
+def encode_nodes(nodes):
+    """ Compact node info, IPv4 only """
+    compact = [(node_id, encode_peers([address]))
+               for (node_id, address) in nodes]
+    return b"".join([node_id + peer for (node_id, peer) in compact if peer])
+
+
+def decode_nodes(data):
+    if len(data) % 26 != 0:
+        raise ValueError("length of compact node info should be "
+                         "a multiple of 26, is %d" % len(data))
+
+    return [(data[i:i+20], decode_peers(data[i+20:i+26])[0])
+            for i in range(0, len(data), 26)]
+
+
+def resolve(address):
+    """ Bootstrap nodes are usually given by hostname, but responses come
+        from an IP address. None if the name doesn't resolve """
+    (host, port) = address
+    try:
+        return (socket.gethostbyname(host), port)
+    except (OSError, UnicodeError) as e:
+        print("couldn't resolve DHT node %s: %s" % (host, e))
+        return None
+
+
+def _valid_response(message):
+    response = message.get(b"r")
+    return isinstance(response, dict) and \
+           type(response.get(b"id")) is bytes and len(response[b"id"]) == 20
+
+
+class Node:
+    __slots__ = ("address", "last_seen", "failures")
+
+    def __init__(self, address):
+        self.address = address
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+
+class RoutingTable:
+    def __init__(self, own_id):
+        self.id = own_id
+        # Bucket i holds the nodes at a distance d from us with
+        # 2**i <= d < 2**(i+1), least recently seen first. Only the buckets
+        # close to us ever fill up, so they're created as needed
+        self.buckets = {}
+
+    def __len__(self):
+        return sum([len(bucket) for bucket in self.buckets.values()])
+
+    def _bucket(self, node_id):
+        index = distance(self.id, node_id).bit_length() - 1
+        return self.buckets.setdefault(index, collections.OrderedDict())
+
+    def add(self, node_id, address):
+        if len(node_id) != 20 or node_id == self.id:
+            return
+
+        bucket = self._bucket(node_id)
+        if node_id in bucket:
+            node = bucket[node_id]
+            node.address = address
+            node.last_seen = time.monotonic()
+            node.failures = 0
+            bucket.move_to_end(node_id)
+            return
+
+        if len(bucket) >= K:
+            (oldest_id, oldest) = next(iter(bucket.items()))
+            # Long lived nodes are the most reliable, keep them if they work
+            if oldest.failures < MAX_FAILURES:
+                return
+            del bucket[oldest_id]
+        bucket[node_id] = Node(address)
+
+    def failed(self, node_id):
+        bucket = self._bucket(node_id)
+        if node_id in bucket:
+            bucket[node_id].failures += 1
+
+    def closest(self, target, count=K):
+        """ (node id, address) of the good nodes closest to target """
+        nodes = [(node_id, node.address)
+                 for bucket in self.buckets.values()
+                 for node_id, node in bucket.items()
+                 if node.failures < MAX_FAILURES]
+        return heapq.nsmallest(count, nodes,
+                               key=lambda node: distance(node[0], target))
+
+
+class Lookup:
+    def __init__(self, dht, target, query, announce_port=None, callback=None):
+        self.dht = dht
+        self.target = target
+        self.query = query
+        self.announce_port = announce_port
+        self.callback = callback
+
+        self.nodes = {}  # node id -> address, everything we heard of
+        self.queried = set()
+        self.failed = set()
+        self.tokens = {}  # node id -> token, for announce_peer
+        self.in_flight = 0
+        self.peers = set()
+
+        self.done = False
+        self.started = time.monotonic()
+        self.latency = None
+        self.messages = 0
+
+    def _send(self, node_id, address):
+        if self.query == b"find_node":
+            args = {b"target": self.target}
+        else:
+            args = {b"info_hash": self.target}
+        self.dht.query(self.query, args, address, node_id, self)
+        if node_id is not None:
+            self.queried.add(node_id)
+        self.in_flight += 1
+        self.messages += 1
+
+    def start(self, addresses=()):
+        for (node_id, address) in self.dht.table.closest(self.target):
+            self.nodes[node_id] = address
+        # Bootstrap nodes, we don't know their id yet
+        for address in filter(None, map(resolve, addresses)):
+            self._send(None, address)
+        self.step()
+
+    def step(self):
+        if self.done:
+            return
+
+        candidates = [node_id for node_id in self.nodes
+                      if node_id not in self.failed]
+        closest = heapq.nsmallest(K, candidates,
+                                  key=lambda i: distance(i, self.target))
+        for node_id in closest:
+            if self.in_flight >= ALPHA:
+                break
+            if node_id not in self.queried:
+                self._send(node_id, self.nodes[node_id])
+
+        if self.in_flight == 0 and all([i in self.queried for i in closest]):
+            self._finish(closest)
+
+    def on_response(self, node_id, address, response):
+        self.in_flight -= 1
+        self.messages += 1
+        self.nodes[node_id] = address
+        self.queried.add(node_id)
+
+        try:
+            for (other_id, other_address) in decode_nodes(
+                    response.get(b"nodes", b"")):
+                if other_id != self.dht.id and other_address[1] != 0:
+                    self.nodes.setdefault(other_id, other_address)
+            for value in response.get(b"values", []):
+                self.peers |= set(decode_peers(value))
+        except (ValueError, TypeError) as e:
+            print("invalid DHT response from %r: %s" % (address, e))
+        if b"token" in response:
+            self.tokens[node_id] = response[b"token"]
+
+        self.step()
+
+    def on_timeout(self, node_id):
+        self.in_flight -= 1
+        if node_id is not None:
+            self.failed.add(node_id)
+        self.step()
+
+    def _finish(self, closest):
+        self.done = True
+        self.latency = time.monotonic() - self.started
+        self.dht.lookups.discard(self)
+        self.dht.metrics["lookups"] += 1
+        self.dht.metrics["lookup_time"] += self.latency
+        self.dht.metrics["lookup_messages"] += self.messages
+
+        if self.announce_port is not None:
+            for node_id in closest:
+                if node_id not in self.tokens:
+                    continue
+                args = {b"info_hash": self.target, b"port": self.announce_port,
+                        b"token": self.tokens[node_id]}
+                self.dht.query(b"announce_peer", args, self.nodes[node_id],
+                               node_id)
+                self.messages += 1
+
+        if self.callback is not None:
+            self.callback(self)
+
+
+class DHTNode:
+    def __init__(self, port=0, host="", node_id=None):
+        self.id = node_id or os.urandom(20)
+        self.table = RoutingTable(self.id)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind((host, port))
+        self.socket.setblocking(False)
+        self.port = self.socket.getsockname()[1]
+
+        self.transactions = {}  # transaction id -> Transaction
+        self._next_transaction = 0
+        self.lookups = set()
+        self.stored_peers = {}  # info hash -> address -> when announced
+
+        self._secrets = [os.urandom(8), os.urandom(8)]
+        self._secret_time = time.monotonic()
+
+        self.metrics = collections.Counter({"lookup_time": 0.0})
+
+    def __repr__(self):
+        return "<DHTNode %s, port %d, %d nodes>" % (
+            self.id.hex()[:8], self.port, len(self.table))
+
+    def close(self):
+        self.socket.close()
+
+    def _send(self, message, address):
+        try:
+            self.socket.sendto(bencode(message), address)
+        except OSError as e:
+            print("couldn't send to DHT node %r: %s" % (address, e))
+
+    def query(self, query, args, address, node_id=None, lookup=None):
+        self._next_transaction = (self._next_transaction + 1) % 65536
+        tid = struct.pack("!H", self._next_transaction)
+        args = {b"id": self.id, **args}
+        self.transactions[tid] = Transaction(query, node_id, address,
+                                             time.monotonic(), lookup)
+        self.metrics["queries_sent"] += 1
+        self._send({b"t": tid, b"y": b"q", b"q": query, b"a": args}, address)
+
+    def _token(self, address, secret):
+        ip = socket.inet_aton(address[0])
+        return hashlib.sha1(secret + ip).digest()[:8]
+
+    def _valid_token(self, token, address):
+        return token in [self._token(address, secret)
+                         for secret in self._secrets]
+
+    def _respond_query(self, message, address):
+        query = message[b"q"]
+        args = message[b"a"]
+        node_id = args[b"id"]
+        response = {b"id": self.id}
+
+        if query == b"ping":
+            pass
+        elif query == b"find_node":
+            response[b"nodes"] = encode_nodes(
+                self.table.closest(args[b"target"]))
+        elif query == b"get_peers":
+            info_hash = args[b"info_hash"]
+            response[b"token"] = self._token(address, self._secrets[-1])
+            peers = list(self.stored_peers.get(info_hash, {}))
+            if peers:
+                response[b"values"] = [encode_peers([peer])
+                                       for peer in peers]
+            else:
+                response[b"nodes"] = encode_nodes(
+                    self.table.closest(info_hash))
+        elif query == b"announce_peer":
+            if not self._valid_token(args[b"token"], address):
+                self._send({b"t": message[b"t"], b"y": b"e",
+                            b"e": [203, b"bad token"]}, address)
+                return
+            port = address[1] if args.get(b"implied_port") else args[b"port"]
+            if type(port) is not int or not 0 < port < 65536:
+                raise ValueError("invalid port %r" % (port,))
+            info_hash = args[b"info_hash"]
+            if (info_hash in self.stored_peers
+                    or len(self.stored_peers) < MAX_INFO_HASHES):
+                peers = self.stored_peers.setdefault(info_hash, {})
+                if len(peers) < MAX_PEERS_PER_HASH:
+                    peers[(address[0], port)] = time.monotonic()
+        else:
+            self._send({b"t": message[b"t"], b"y": b"e",
+                        b"e": [204, b"method unknown"]}, address)
+            return
+
+        self.table.add(node_id, address)
+        self._send({b"t": message[b"t"], b"y": b"r",
+                    b"r": response}, address)
+
+    def _handle_response(self, message, address):
+        transaction = self.transactions.get(message[b"t"])
+        if transaction is None or transaction.address != address:
+            return  # Timed out already, or not for us
+        del self.transactions[message[b"t"]]
+
+        if message[b"y"] == b"e" or not _valid_response(message):
+            if message[b"y"] == b"e":
+                self.metrics["errors_received"] += 1
+                print("DHT error from %r: %r" % (address, message.get(b"e")))
+            else:
+                self.metrics["invalid_messages"] += 1
+                print("invalid DHT response from %r" % (address,))
+            # Like a timeout, or the lookup would wait for this one forever
+            if transaction.node_id is not None:
+                self.table.failed(transaction.node_id)
+            if transaction.lookup is not None:
+                transaction.lookup.on_timeout(transaction.node_id)
+            return
+
+        response = message[b"r"]
+        node_id = response[b"id"]
+        self.metrics["responses_received"] += 1
+        self.table.add(node_id, address)
+        if transaction.lookup is not None:
+            transaction.lookup.on_response(node_id, address, response)
+
+    def _handle_datagram(self, data, address):
+        try:
+            message = bdecode(data)
+            if message[b"y"] == b"q":
+                self.metrics["queries_received"] += 1
+                self._respond_query(message, address)
+            elif message[b"y"] in (b"r", b"e"):
+                self._handle_response(message, address)
+        except (ValueError, KeyError, TypeError, AttributeError,
+                OSError) as e:
+            self.metrics["invalid_messages"] += 1
+            print("invalid DHT message from %r: %s" % (address, e))
+
+    def handle_read(self):
+        while True:
+            try:
+                (data, address) = self.socket.recvfrom(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # ICMP errors from earlier datagrams end up here
+                print("DHT socket error: %s" % e)
+                continue
+            self._handle_datagram(data, address)
+
+    def tick(self):
+        now = time.monotonic()
+        for tid, transaction in list(self.transactions.items()):
+            if now - transaction.sent < QUERY_TIMEOUT:
+                continue
+            del self.transactions[tid]
+            self.metrics["timeouts"] += 1
+            if transaction.node_id is not None:
+                self.table.failed(transaction.node_id)
+            if transaction.lookup is not None:
+                transaction.lookup.on_timeout(transaction.node_id)
+
+        if now - self._secret_time > TOKEN_INTERVAL:
+            self._secrets = [self._secrets[-1], os.urandom(8)]
+            self._secret_time = now
+            for info_hash, peers in list(self.stored_peers.items()):
+                for peer in [p for p, when in peers.items()
+                             if now - when > PEER_TTL]:
+                    del peers[peer]
+                if not peers:
+                    del self.stored_peers[info_hash]
+
+    def _lookup(self, target, query, addresses=(), **kwargs):
+        lookup = Lookup(self, target, query, **kwargs)
+        self.lookups.add(lookup)
+        lookup.start(addresses)
+        return lookup
+
+    def bootstrap(self, addresses, callback=None):
+        """ Fill the routing table by looking up our own id """
+        return self._lookup(self.id, b"find_node", addresses,
+                            callback=callback)
+
+    def get_peers(self, info_hash, announce_port=None, callback=None):
+        """ Look for peers on info_hash, and announce ourselves to the
+            closest nodes if announce_port is given """
+        return self._lookup(info_hash, b"get_peers",
+                            announce_port=announce_port, callback=callback)
+
+
+def run_nodes(nodes, until, timeout=30):
+    """ Drive nodes until until() is true or the timeout passes """
+    selector = selectors.DefaultSelector()
+    for node in nodes:
+        selector.register(node.socket, selectors.EVENT_READ, node)
+
+    deadline = time.monotonic() + timeout
+    while not until() and time.monotonic() < deadline:
+        for key, _ in selector.select(0.1):
+            key.data.handle_read()
+        for node in nodes:
+            node.tick()
+    selector.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a DHT on localhost")
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=10)
+    args = parser.parse_args()
+
+    nodes = [DHTNode(host="127.0.0.1") for _ in range(args.nodes)]
+    first = ("127.0.0.1", nodes[0].port)
+    for node in nodes[1:]:
+        lookup = node.bootstrap([first])
+        run_nodes(nodes, lambda: lookup.done)
+    # Once more, now that everyone's in
+    lookups = [node.bootstrap([first]) for node in nodes]
+    run_nodes(nodes, lambda: all([lookup.done for lookup in lookups]))
+    print("Routing table sizes: min %d, max %d" % (
+        min([len(node.table) for node in nodes]),
+        max([len(node.table) for node in nodes])))
+
+    info_hash = os.urandom(20)
+    announce = nodes[-1].get_peers(info_hash, announce_port=6881)
+    run_nodes(nodes, lambda: announce.done)
+    run_nodes(nodes, lambda: False, timeout=0.5)  # let the announces land
+
+    found = 0
+    for node in nodes[:args.lookups]:
+        lookup = node.get_peers(info_hash)
+        run_nodes(nodes, lambda: lookup.done)
+        found += ("127.0.0.1", 6881) in lookup.peers
+        print("Lookup from %r: %.1f ms, %d messages, %d peers" % (
+            node, 1000 * lookup.latency, lookup.messages, len(lookup.peers)))
+    print("Found the announced peer in %d of %d lookups" %
+          (found, args.lookups))
+
+    totals = collections.Counter()
+    for node in nodes:
+        totals.update(node.metrics)
+    print("Totals: %s" % ", ".join(["%s %s" % (key, round(value, 3))
+                                    for key, value in sorted(totals.items())]))
+    for node in nodes:
+        node.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import hashlib
 import os
 import mmap
+import threading
 from bitarray import bitarray
 
 BLOCKSIZE = 16 * 1024
@@ -16,15 +17,24 @@ class Piece:
         self.filemap = filemap
         self.offset = offset
         self.verified = False
+        # If set, blocks are kept in memory until the piece verifies, so
+        # other processes writing the same piece never see unverified data
+        self.buffered = False
+        self.buffer = None
 
         self.num_blocks = (size + BLOCKSIZE - 1) // BLOCKSIZE
         self.block_progress = bitarray([False] * self.num_blocks)
 
     def verify(self):
-        piece = self.filemap[self.offset : self.offset+self.size]
+        if self.buffer is not None:
+            piece = self.buffer
+        else:
+            piece = self.filemap[self.offset : self.offset+self.size]
         sha = hashlib.sha1(piece).hexdigest()
         self.verified = sha == self.hash
         if self.verified:
+            if self.buffer is not None:
+                self.filemap[self.offset : self.offset+self.size] = self.buffer
             try:
                 self.filemap.flush(self.offset, self.size)
             except OSError:
@@ -34,6 +44,7 @@ class Piece:
             self.block_progress = None
         else:
             self.block_progress = bitarray([False] * self.num_blocks)
+        self.buffer = None
 
         print("Verified? %s" % self.verified)
 
@@ -58,8 +69,13 @@ class Piece:
 
         assert len(block) == self.get_block_length(block_idx)
 
-        self.filemap[self.offset + begin:
-                     self.offset + begin + len(block)] = block
+        if self.buffered:
+            if self.buffer is None:
+                self.buffer = bytearray(self.size)
+            self.buffer[begin : begin + len(block)] = block
+        else:
+            self.filemap[self.offset + begin:
+                         self.offset + begin + len(block)] = block
 
         self.block_progress[block_idx] = True
 
@@ -77,6 +93,7 @@ class File:
 
         self.filename = filename
         self.filesize = filesize
+        self.piece_size = piece_size
 
         fileno = os.open(self.filename, os.O_CREAT | os.O_RDWR)
         os.ftruncate(fileno, self.filesize)
@@ -96,23 +113,82 @@ class File:
             piece = Piece(size, piece_hashes[index], self.filemap, offset)
             self.pieces.append(piece)
 
+        # Maintained incrementally as pieces get verified, so it never has to
+        # be rebuilt from the piece list. Padded to a whole number of bytes,
+        # like the bitfield message on the wire.
+        self.bitfield = bitarray(self.num_pieces * '0', endian="big")
+        self.bitfield.fill()
+        self.num_verified = 0
+
+        # Readers in other threads block on this until their pieces are in
+        self.verified_cond = threading.Condition()
+        self.reader_offset = None
+
     def __del__(self):
         self.filemap.flush()
         self.filemap.close()
 
+    def _update_bitfield(self, index):
+        verified = self.pieces[index].verified
+        if verified != self.bitfield[index]:
+            with self.verified_cond:
+                self.bitfield[index] = verified
+                self.num_verified += 1 if verified else -1
+                self.verified_cond.notify_all()
+
+    def mark_verified(self, index):
+        """ For pieces someone else verified on the same file on disk """
+        piece = self.pieces[index]
+        piece.verified = True
+        piece.block_progress = None
+        piece.buffer = None
+        self._update_bitfield(index)
+
+    def set_buffered(self, buffered=True):
+        """ Keep the blocks of every piece in memory until it verifies, for
+            when other processes download into the same file """
+        for piece in self.pieces:
+            piece.buffered = buffered
+
     def get_bitfield(self):
-        bitfield = bitarray([piece.verified for piece in self.pieces])
-        bitfield.fill()
-        return bitfield
+        # This is the live bitfield, don't modify it
+        return self.bitfield
+
+    def is_complete(self):
+        return self.num_verified == self.num_pieces
 
     def verify(self):
         verified = [piece.verify() for piece in self.pieces]
+        for index in range(self.num_pieces):
+            self._update_bitfield(index)
         print("%d verified out of %d" % (sum(verified), len(verified)))
 
     def store_block(self, index, begin, block):
         assert index < self.num_pieces
-        return self.pieces[index].store_block(begin, block)
+        self.pieces[index].store_block(begin, block)
+        self._update_bitfield(index)
+        return self.pieces[index].verified
 
     def read_block(self, index, begin, length):
         assert index < self.num_pieces
         return self.pieces[index].read_block(begin, length)
+
+    def read(self, offset, length, timeout=None):
+        """ Read from the payload, blocking until every piece covering the
+            range is verified. Meant to be called from another thread than
+            the one running the download """
+        if offset < 0 or length < 0 or offset + length > self.filesize:
+            raise ValueError("read outside of file: %d:%d" % (offset, length))
+        if length == 0:
+            return b""
+
+        first = offset // self.piece_size
+        last = (offset + length - 1) // self.piece_size
+        with self.verified_cond:
+            # The piece picker reads ahead from here
+            self.reader_offset = offset
+            if not self.verified_cond.wait_for(
+                    lambda: self.bitfield[first:last + 1].all(), timeout):
+                raise TimeoutError("pieces %d-%d not available" % (first, last))
+
+        return self.filemap[offset : offset + length]
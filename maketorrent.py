@@ -0,0 +1,192 @@
+""" Creating .torrent files
+
+usage: python maketorrent.py PATH [-o OUTPUT] [-a ANNOUNCE ...]
+
+PATH can be a single file or a directory, which becomes a multi-file
+torrent. One thread reads the payload into pieces while a pool of threads
+hashes them; hashlib releases the GIL while hashing, so this scales over
+cores.
+"""
+import argparse
+import collections
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bencode import bencode
+from file import BLOCKSIZE
+
+MIN_PIECE_SIZE = BLOCKSIZE
+MAX_PIECE_SIZE = 16 * 1024 * 1024
+# Pick the smallest power of two piece size that gives at most this many
+TARGET_PIECES = 1500
+# How many pieces can be read ahead of the hashers
+READ_AHEAD = 16
+
+
+def pick_piece_size(total_size):
+    piece_size = MIN_PIECE_SIZE
+    while piece_size < MAX_PIECE_SIZE and \
+          total_size > TARGET_PIECES * piece_size:
+        piece_size *= 2
+    return piece_size
+
+
+def _list_files(path):
+    """ (path on disk, path in torrent) for every file under a directory,
+        in a stable order """
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            full_path = os.path.join(root, name)
+            relative = os.path.relpath(full_path, path)
+            files.append((full_path, relative.split(os.sep)))
+    return files
+
+
+def _read_pieces(paths, piece_size, pieces):
+    """ Reader thread, puts the payload on the queue piece by piece as if
+        all files were concatenated. None marks the end """
+    try:
+        buffer = bytearray()
+        for path in paths:
+            with open(path, "rb") as payload:
+                while True:
+                    data = payload.read(piece_size - len(buffer))
+                    if not data:
+                        break
+                    buffer += data
+                    if len(buffer) == piece_size:
+                        pieces.put(bytes(buffer))
+                        buffer = bytearray()
+        if buffer:
+            pieces.put(bytes(buffer))
+        pieces.put(None)
+    except OSError as e:
+        pieces.put(e)
+
+
+def _sha1(piece):
+    return hashlib.sha1(piece).digest()
+
+
+def hash_pieces(paths, piece_size, workers=None):
+    """ The concatenated SHA-1 digests of the pieces of the given files """
+    workers = workers or os.cpu_count() or 1
+    pieces = queue.Queue(READ_AHEAD)
+    reader = threading.Thread(target=_read_pieces, daemon=True,
+                              args=(paths, piece_size, pieces))
+    reader.start()
+
+    digests = []
+    pending = collections.deque()
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            piece = pieces.get()
+            if isinstance(piece, OSError):
+                raise piece
+            if piece is None:
+                break
+            pending.append(executor.submit(_sha1, piece))
+            # Keep the order, and don't let the hashers run too far ahead
+            while len(pending) > 2 * workers:
+                digests.append(pending.popleft().result())
+        digests += [future.result() for future in pending]
+
+    reader.join()
+    return b"".join(digests)
+
+
+def make_torrent(path, announce=(), piece_size=None, workers=None,
+                 comment=None, private=False):
+    """ Returns the metainfo dictionary for a file or directory """
+    path = os.path.abspath(path)
+    name = os.path.basename(path)
+
+    info = {}
+    if os.path.isdir(path):
+        files = _list_files(path)
+        if not files:
+            raise ValueError("no files in %s" % path)
+        paths = [full_path for (full_path, _) in files]
+        info[b"files"] = [{b"length": os.path.getsize(full_path),
+                           b"path": [part.encode() for part in parts]}
+                          for (full_path, parts) in files]
+        total_size = sum([entry[b"length"] for entry in info[b"files"]])
+    else:
+        paths = [path]
+        total_size = os.path.getsize(path)
+        info[b"length"] = total_size
+
+    if total_size == 0:
+        raise ValueError("can't make a torrent of an empty payload")
+    if piece_size is None:
+        piece_size = pick_piece_size(total_size)
+    elif piece_size < MIN_PIECE_SIZE or piece_size & (piece_size - 1):
+        raise ValueError("piece size must be a power of two of at least %d" %
+                         MIN_PIECE_SIZE)
+
+    info[b"name"] = name.encode()
+    info[b"piece length"] = piece_size
+    info[b"pieces"] = hash_pieces(paths, piece_size, workers)
+    if private:
+        info[b"private"] = 1
+
+    metainfo = {b"info": info,
+                b"created by": b"python-bittorrent",
+                b"creation date": int(time.time())}
+    if announce:
+        metainfo[b"announce"] = announce[0].encode()
+        if len(announce) > 1:
+            metainfo[b"announce-list"] = [[url.encode()] for url in announce]
+    if comment:
+        metainfo[b"comment"] = comment.encode()
+
+    return metainfo
+
+
+def _piece_size(value):
+    """ --piece-size is given in kB """
+    try:
+        piece_size = int(value) * 1024
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a number: %s" % value)
+    if piece_size < MIN_PIECE_SIZE or piece_size & (piece_size - 1):
+        raise argparse.ArgumentTypeError(
+            "must be a power of two of at least %d" % (MIN_PIECE_SIZE // 1024))
+    return piece_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a .torrent file")
+    parser.add_argument("path", help="file or directory to share")
+    parser.add_argument("-o", "--output",
+                        help="where to write it, PATH.torrent by default")
+    parser.add_argument("-a", "--announce", action="append", default=[],
+                        help="tracker URL, can be given more than once")
+    parser.add_argument("--piece-size", type=_piece_size,
+                        help="piece size in kB, picked automatically if unset")
+    parser.add_argument("--workers", type=int,
+                        help="hashing threads, one per core by default")
+    parser.add_argument("--comment")
+    parser.add_argument("--private", action="store_true")
+    args = parser.parse_args()
+
+    output = args.output or os.path.abspath(args.path) + ".torrent"
+    try:
+        metainfo = make_torrent(args.path, args.announce, args.piece_size,
+                                args.workers, args.comment, args.private)
+        with open(output, "wb") as tr_file:
+            tr_file.write(bencode(metainfo))
+    except (ValueError, OSError) as e:
+        parser.error(e)
+    print("Wrote %s, %d pieces of %d bytes" % (
+        output, len(metainfo[b"info"][b"pieces"]) // 20,
+        metainfo[b"info"][b"piece length"]))
+
+
+if __name__ == "__main__":
+    main()
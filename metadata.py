@@ -0,0 +1,126 @@
+import hashlib
+import time
+
+# ut_metadata (BEP 9) transfers the info dictionary in pieces of this size
+METADATA_PIECE_SIZE = 16 * 1024
+# Don't believe peers claiming the info dictionary is bigger than this
+MAX_METADATA_SIZE = 16 * 1024 * 1024
+# Ask another peer if a piece hasn't arrived after this many seconds
+METADATA_TIMEOUT = 10
+
+
+class MetadataFetcher:
+    """ Collects the info dictionary from several peers at once. Once that
+        fails the hash check we can't tell who lied, so from then on all of
+        it comes from one peer at a time, and peers that fail it are banned """
+    def __init__(self, info_hash):
+        self.info_hash = info_hash
+        self.banned = set()
+        self.single_source = False
+        self.reset()
+
+    def reset(self):
+        """ Start over, but remember who we banned """
+        self.size = None
+        self.num_pieces = None
+        self.pieces = None
+        self.requested = {}  # piece -> (peer, time requested)
+        # Who told us the size and sent each piece
+        self.size_from = None
+        self.sources = None
+
+        # Pieces are hashed as soon as all pieces before them are in
+        self._sha = hashlib.sha1()
+        self._hashed = 0
+
+    def set_size(self, peer, size):
+        if self.size is not None or peer in self.banned:
+            return
+        if size <= 0 or size > MAX_METADATA_SIZE:
+            print("peer announced invalid metadata size %d" % size)
+            return
+
+        self.size = size
+        self.size_from = peer
+        self.sources = [None] * ((size + METADATA_PIECE_SIZE - 1) //
+                                 METADATA_PIECE_SIZE)
+        self.num_pieces = (size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE
+        self.pieces = [None] * self.num_pieces
+
+    def _piece_length(self, piece):
+        if piece == self.num_pieces - 1 and self.size % METADATA_PIECE_SIZE:
+            return self.size % METADATA_PIECE_SIZE
+        return METADATA_PIECE_SIZE
+
+    def next_request(self, peer):
+        """ A metadata piece to ask from peer, or None. We only keep one
+            request outstanding per peer """
+        if self.size is None or peer in self.banned:
+            return None
+        if self.single_source and peer is not self.size_from:
+            return None
+
+        now = time.monotonic()
+        for piece, (other, when) in self.requested.items():
+            if other is peer and now - when < METADATA_TIMEOUT:
+                return None
+
+        for piece in range(self.num_pieces):
+            if self.pieces[piece] is not None:
+                continue
+            if piece in self.requested:
+                (_, when) = self.requested[piece]
+                if now - when < METADATA_TIMEOUT:
+                    continue
+            self.requested[piece] = (peer, now)
+            return piece
+
+        return None
+
+    def piece_received(self, peer, piece, data):
+        if self.size is None or not 0 <= piece < self.num_pieces:
+            print("peer sent metadata piece we didn't ask for: %d" % piece)
+            return
+        if piece not in self.requested or self.requested[piece][0] is not peer:
+            print("peer sent metadata piece %d we didn't ask it for" % piece)
+            return
+        del self.requested[piece]
+        if self.pieces[piece] is not None:
+            return
+        if len(data) != self._piece_length(piece):
+            print("metadata piece %d has wrong length %d" % (piece, len(data)))
+            return
+
+        self.pieces[piece] = data
+        self.sources[piece] = peer
+        while (self._hashed < self.num_pieces and
+               self.pieces[self._hashed] is not None):
+            self._sha.update(self.pieces[self._hashed])
+            self._hashed += 1
+
+    def piece_rejected(self, peer, piece):
+        if piece in self.requested and self.requested[piece][0] is peer:
+            del self.requested[piece]
+
+    def peer_gone(self, peer):
+        if self.single_source and peer is self.size_from:
+            self.reset()
+            return
+        for piece in [p for p, (other, _) in self.requested.items()
+                      if other is peer]:
+            del self.requested[piece]
+
+    def done(self):
+        return self.size is not None and self._hashed == self.num_pieces
+
+    def result(self):
+        """ The verified info dictionary, still bencoded """
+        assert self.done()
+        if self._sha.hexdigest() != self.info_hash:
+            if self.single_source:
+                self.banned.add(self.size_from)
+            self.single_source = True
+            self.reset()
+            raise ValueError("metadata doesn't match info hash")
+
+        return b"".join(self.pieces)
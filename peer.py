@@ -1,13 +1,30 @@
 from collections import namedtuple
 from enum import Enum
 import struct
+import time
 from bitarray import bitarray
+from bencode import bdecode, bdecode_prefix, bencode
+from file import BLOCKSIZE
+from metadata import METADATA_PIECE_SIZE
+from tracker import decode_peers, encode_peers
 
 # TODO TransferHistory class, containing the bytes transferred the last n
 # seconds, to estimate the recent transfer speed. Keep total transferred bytes
 
 Request = namedtuple("Request", "index begin length")
 
+# How many canceled requests to remember, in case the blocks still arrive
+MAX_CANCELLED = 256
+
+# Extension messages (BEP 10) we support, and the ids we want them sent with
+EXTENSIONS = {b"ut_metadata": 1, b"ut_pex": 2}
+CLIENT_NAME = b"python-bittorrent"
+
+# Peer exchange (BEP 11) messages shouldn't come more often than once a
+# minute, and shouldn't contain more than 50 added and 50 dropped peers
+PEX_INTERVAL = 60
+PEX_MAX_PEERS = 50
+
 
 # TODO Add new states WAIT_BLOCK and DONE_BLOCK, and use socket.sendfile
 # to store it immediately without copying the buffers
@@ -80,7 +97,7 @@ class MessageProducer:
 
 
 class Peer:
-    def __init__(self, socket, address, peer_id, file):
+    def __init__(self, socket, address, peer_id, file, reserved=8*b'\0'):
         # TODO Split this class in PeerState and PeerInfo, and merge with
         # MessageProducer? A lot of these attributes are only manipulated
         # from the outside. And Bittorrent messages can only change the state
@@ -88,11 +105,26 @@ class Peer:
         self.address = address
         self.peer_id = peer_id
         self.file = file  # FIXME Remove dependency
+        self.metadata = None  # our info dictionary, bencoded
         self.downloaded = 0
         self.uploaded = 0
         self.message_producer = MessageProducer()
         self.write_buffer = b""
         self.dead = False
+        # BEP 6, both sides have to set this bit in the handshake
+        self.fast = bool(reserved[7] & 0x04)
+        # BEP 10, the extensions the peer supports and their message ids
+        self.extended = bool(reserved[5] & 0x10)
+        self.extensions = {}
+        self.metadata_size = None
+        self.listen_port = None  # where the peer accepts connections
+        self.incoming = False  # whether the peer connected to us
+        self.our_port = None  # where we accept connections
+        # When we last sent or received peer exchange messages, and the peers
+        # this peer already knows about from us
+        self.pex_sent = None
+        self.pex_received = None
+        self.pex_known = set()
 
         # TODO Abstract out this peer state ?
         self.state = {}
@@ -100,12 +132,42 @@ class Peer:
         self.state["is_interested"] = False
         self.state["am_choking"] = True
         self.state["am_interested"] = False
-        self.state["has_pieces"] = bitarray(self.file.num_pieces * '0',
-                                            endian="big")
-        self.state["has_pieces"].fill()
+        # Without a file we're still fetching the metadata, and don't know
+        # how many pieces there are yet. See set_file
+        self.state["has_pieces"] = bitarray(endian="big")
+        self.state["has_all"] = False
+        self.state["early_haves"] = set()
+        if self.file is not None:
+            self.set_file(self.file)
         self.state["in_requests"] = []
         self.state["out_requests"] = []
         self.state["completed_requests"] = []
+        self.state["cancelled_requests"] = []
+        self.state["metadata_pieces"] = []  # (piece, data or None if rejected)
+        self.state["pex_added"] = []
+        self.state["pex_dropped"] = []
+
+    def set_file(self, file):
+        """ Fix up the peer's bitfield once we know the number of pieces """
+        self.file = file
+        has_pieces = bitarray(self.file.num_pieces * '0', endian="big")
+        has_pieces.fill()
+        received = self.state["has_pieces"]
+        if len(received) > len(has_pieces) or received[file.num_pieces:].any():
+            print("peer has pieces beyond the end of the file")
+            self.dead = True
+        else:
+            has_pieces[:len(received)] = received
+        for index in self.state["early_haves"]:
+            if index >= file.num_pieces:
+                print("peer sent out-of-bounds piece index: %d" % index)
+                self.dead = True
+            else:
+                has_pieces[index] = True
+        self.state["early_haves"] = set()
+        if self.state["has_all"]:
+            has_pieces[:file.num_pieces] = True
+        self.state["has_pieces"] = has_pieces
 
     def __repr__(self):
         flags = ""
@@ -114,13 +176,15 @@ class Peer:
         flags += "C" if self.state["am_choking"]    else "U"
         flags += "I" if self.state["am_interested"] else "D"
 
+        num_pieces = self.file.num_pieces if self.file else 0
         return "<Peer %s, %s, %d/%d, Down: %d, Up: %d>" % (
             self.address, flags, sum(self.state["has_pieces"]),
-            self.file.num_pieces, self.downloaded, self.uploaded)
+            num_pieces, self.downloaded, self.uploaded)
 
     def _handle_request(self, payload):
         (index, begin, length) = struct.unpack("!III", payload)
-        if not self.file.pieces[index].verified:
+        if self.file is None or index >= self.file.num_pieces or \
+           not self.file.pieces[index].verified:
             print("peer asked for piece we don't have")
             self.dead = True
             return
@@ -142,6 +206,10 @@ class Peer:
         length = len(block)
         request = Request(index, begin, length)
         print("Incoming block data! %d:%d:%d" % request)
+        if request in self.state["cancelled_requests"]:
+            print("Block arrived after we canceled it")
+            self.state["cancelled_requests"].remove(request)
+            return
         if request not in self.state["out_requests"]:
             print("I didn't ask for this...")
             self.dead = True
@@ -159,11 +227,118 @@ class Peer:
         request = Request(index, begin, length)
         print("Cancel message %d:%d:%d" % request)
         if request not in self.state["in_requests"]:
-            print("Peer canceled block it never requested...")
-            self.dead = True
+            # We might have sent it already, or it was never requested
+            print("Peer canceled block we don't have queued")
             return
         self.state["in_requests"].remove(request)
 
+    def _handle_reject(self, payload):
+        index, begin, length = struct.unpack("!III", payload)
+        request = Request(index, begin, length)
+        print("Reject message %d:%d:%d" % request)
+        if request in self.state["cancelled_requests"]:
+            self.state["cancelled_requests"].remove(request)
+            return
+        if request not in self.state["out_requests"]:
+            print("Peer rejected block we never requested...")
+            self.dead = True
+            return
+        self.state["out_requests"].remove(request)
+
+    def _handle_extended_handshake(self, payload):
+        try:
+            handshake = bdecode(payload)
+            extensions = {}
+            for name, ext_id in handshake.get(b"m", {}).items():
+                # 0 means the peer disabled the extension
+                if type(ext_id) is not int or not 0 <= ext_id <= 255:
+                    raise ValueError("invalid extension id %r" % (ext_id,))
+                if ext_id != 0:
+                    extensions[name] = ext_id
+            metadata_size = handshake.get(b"metadata_size")
+            if metadata_size is not None and type(metadata_size) is not int:
+                raise ValueError("invalid metadata size %r" % (metadata_size,))
+            port = handshake.get(b"p")
+            if port is not None and \
+               (type(port) is not int or not 0 < port < 65536):
+                raise ValueError("invalid listen port %r" % (port,))
+        except (ValueError, AttributeError) as e:
+            print("invalid extension handshake: %s" % e)
+            self.dead = True
+            return
+
+        self.extensions = extensions
+        if metadata_size is not None:
+            self.metadata_size = metadata_size
+        if port is not None:
+            self.listen_port = port
+        print("Extensions: %r" % list(self.extensions.keys()))
+
+    def _handle_metadata(self, payload):
+        try:
+            (message, end) = bdecode_prefix(payload)
+            msg_type = message[b"msg_type"]
+            piece = message[b"piece"]
+            if type(msg_type) is not int or type(piece) is not int:
+                raise ValueError("msg_type and piece should be integers")
+        except (ValueError, KeyError, TypeError) as e:
+            print("invalid metadata message: %s" % e)
+            self.dead = True
+            return
+
+        if b"ut_metadata" not in self.extensions:
+            print("peer sent metadata message without supporting it")
+            self.dead = True
+        elif msg_type == 0:  # request
+            if self.metadata is None or \
+               not 0 <= piece * METADATA_PIECE_SIZE < len(self.metadata):
+                self._send_metadata_message(2, piece)
+            else:
+                offset = piece * METADATA_PIECE_SIZE
+                data = self.metadata[offset : offset + METADATA_PIECE_SIZE]
+                self._send_metadata_message(1, piece, data)
+        elif msg_type == 1:  # data
+            print("Metadata piece %d" % piece)
+            self.state["metadata_pieces"].append((piece, payload[end:]))
+        elif msg_type == 2:  # reject
+            print("Metadata piece %d rejected" % piece)
+            self.state["metadata_pieces"].append((piece, None))
+        else:
+            print("unknown metadata message type: %d" % msg_type)
+
+    def _handle_pex(self, payload):
+        now = time.monotonic()
+        if self.pex_received is not None and \
+           now - self.pex_received < PEX_INTERVAL / 2:
+            print("peer is sending peer exchange messages too fast, ignoring")
+            return
+        self.pex_received = now
+
+        try:
+            message = bdecode(payload)
+            added = decode_peers(message.get(b"added", b""))
+            dropped = decode_peers(message.get(b"dropped", b""))
+        except (ValueError, TypeError, AttributeError) as e:
+            print("invalid peer exchange message: %s" % e)
+            self.dead = True
+            return
+
+        print("Peer exchange: %d added, %d dropped" % (len(added), len(dropped)))
+        self.state["pex_added"] += added[:PEX_MAX_PEERS]
+        self.state["pex_dropped"] += dropped[:PEX_MAX_PEERS]
+
+    def _handle_extended(self, payload):
+        ext_id = payload[0]
+        if ext_id == 0:
+            self._handle_extended_handshake(payload[1:])
+        elif ext_id == EXTENSIONS[b"ut_metadata"]:
+            self._handle_metadata(payload[1:])
+        elif ext_id == EXTENSIONS[b"ut_pex"]:
+            self._handle_pex(payload[1:])
+        else:
+            print("peer sent unknown extension message: %d" % ext_id)
+            self.dead = True
+
     def _handle_message(self, length, msg_id, payload):
         if length == 0:
             print("Received keepalive")
@@ -186,6 +361,10 @@ class Peer:
         elif msg_id == 4:
             print("He has a piece 🔫")
             (index,) = struct.unpack("!I", payload)
+            if self.file is None:
+                # Until we know how big the bitfield should be
+                self.state["early_haves"].add(index)
+                return
             if index >= self.file.num_pieces:
                 print("peer sent out-of-bounds piece index: %d" % index)
                 self.dead = True
@@ -201,6 +380,23 @@ class Peer:
             self._handle_block(payload)
         elif msg_id == 8:
             self._handle_cancel(payload)
+        elif msg_id == 13 and self.fast:
+            print("Suggest piece, ignoring")
+        elif msg_id == 14 and self.fast:
+            print("He has everything 💯")
+            self.state["has_all"] = True
+            if self.file is not None:
+                self.state["has_pieces"][:self.file.num_pieces] = True
+        elif msg_id == 15 and self.fast:
+            print("He has nothing")
+            self.state["has_all"] = False
+            self.state["has_pieces"].setall(False)
+        elif msg_id == 16 and self.fast:
+            self._handle_reject(payload)
+        elif msg_id == 17 and self.fast:
+            print("Allowed fast, ignoring")
+        elif msg_id == 20 and self.extended:
+            self._handle_extended(payload)
         else:
             print("peer sent message with unknown id: %d" % msg_id)
             self.dead = True
@@ -212,11 +408,21 @@ class Peer:
         elif msg_id == 4:  # have
             return length == 1 + 4
         elif msg_id == 5:  # bitfield
+            if self.file is None:
+                return length > 1
             return length == 1 + (len(self.state["has_pieces"]) + 7) // 8
         elif msg_id in (6, 8):  # request, cancel
             return length == 1 + 4 + 4 + 4
         elif msg_id == 7:  # block
             return length > 1 + 4 + 4 and length <= 1 + 4 + 4 + BLOCKSIZE
+        elif msg_id in (13, 17) and self.fast:  # suggest, allowed fast
+            return length == 1 + 4
+        elif msg_id in (14, 15) and self.fast:  # have all, have none
+            return length == 1
+        elif msg_id == 16 and self.fast:  # reject request
+            return length == 1 + 4 + 4 + 4
+        elif msg_id == 20 and self.extended:  # extended
+            return length > 1 + 1 and length <= 1 + 1 + 2 * BLOCKSIZE
         else:
             return False
 
@@ -245,7 +451,7 @@ class Peer:
         else:
             length = 1 + len(payload)
             msg = struct.pack("!IB", length, msg_id) + payload
-            assert self._check_length(msg_id, length)
+            assert self._check_length(length, msg_id)
 
         self.write_buffer += msg
 
@@ -286,13 +492,65 @@ class Peer:
         print("Sending have")
         self._send(4, struct.pack("!I", index))
 
+    def send_haves(self, indices):
+        # Have suppression: don't announce pieces the peer already has
+        indices = [i for i in indices if not self.state["has_pieces"][i]]
+        if not indices:
+            return
+        print("Sending %d haves" % len(indices))
+        self.write_buffer += b"".join([struct.pack("!IBI", 1 + 4, 4, index)
+                                       for index in indices])
+
+    def send_extended_handshake(self):
+        print("Sending extension handshake")
+        handshake = {b"m": EXTENSIONS, b"v": CLIENT_NAME}
+        if self.metadata is not None:
+            handshake[b"metadata_size"] = len(self.metadata)
+        if self.our_port is not None:
+            handshake[b"p"] = self.our_port
+        self._send(20, b"\0" + bencode(handshake))
+
+    def _send_metadata_message(self, msg_type, piece, data=b""):
+        message = {b"msg_type": msg_type, b"piece": piece}
+        if msg_type == 1:
+            message[b"total_size"] = len(self.metadata)
+        ext_id = self.extensions[b"ut_metadata"]
+        self._send(20, bytes([ext_id]) + bencode(message) + data)
+
+    def request_metadata(self, piece):
+        print("Requesting metadata piece %d" % piece)
+        self._send_metadata_message(0, piece)
+
+    def send_pex(self, added, dropped):
+        print("Sending peer exchange")
+        message = {b"added": encode_peers(added),
+                   b"dropped": encode_peers(dropped)}
+        ext_id = self.extensions[b"ut_pex"]
+        self._send(20, bytes([ext_id]) + bencode(message))
+        self.pex_sent = time.monotonic()
+        self.pex_known = (self.pex_known | set(added)) - set(dropped)
+
     def send_bitfield(self):
-        print("Sending bitfield")
-        payload = self.file.get_bitfield().tobytes()
-        self._send(5, payload)
+        """ Also called without a file, when we're still fetching the
+            metadata, as the Fast extension wants one of these either way """
+        if self.file is None or self.file.num_verified == 0:
+            # The bitfield message is optional if we have nothing
+            if self.fast:
+                print("Sending have none")
+                self._send(15)
+        elif self.fast and self.file.is_complete():
+            print("Sending have all")
+            self._send(14)
+        else:
+            print("Sending bitfield")
+            self._send(5, self.file.get_bitfield().tobytes())
 
     def request(self, request):
         print("Sending request")
+        # Asking again after cancelling, e.g. when the piece failed its hash
+        # check: the reply is for this request, not the cancelled one
+        if request in self.state["cancelled_requests"]:
+            self.state["cancelled_requests"].remove(request)
         self.state["out_requests"].append(request)
         index, begin, length = request
         self._send(6, struct.pack("!III", index, begin, length))
@@ -307,5 +565,10 @@ class Peer:
 
     def send_cancel(self, request):
         index, begin, length = request
+        # The block might still be on its way, remember we canceled it so we
+        # don't mistake it for an unsolicited one
+        self.state["out_requests"].remove(request)
+        self.state["cancelled_requests"].append(request)
+        del self.state["cancelled_requests"][:-MAX_CANCELLED]
         print("Sending cancel")
         self._send(8, struct.pack("!III", index, begin, length))
@@ -0,0 +1,259 @@
+import random
+import time
+from bitarray import bitarray
+from file import BLOCKSIZE
+from peer import Request
+
+# In endgame mode, request every block from at most this many peers
+ENDGAME_DUPLICATES = 3
+
+# Piece priorities. Pieces with priority 0 aren't downloaded at all, and
+# higher priorities are always picked first
+PRIORITY_SKIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_MAX = 7
+
+# When streaming, how many pieces past the reader's position get a deadline,
+# and how far apart in seconds those deadlines are
+READAHEAD_PIECES = 8
+DEADLINE_STEP = 0.5
+
+
+def random_set_bit(bitfield):
+    nset = bitfield.count()
+    nrandom = random.randrange(nset)
+
+    index = bitfield.index(True)
+    while nrandom > 0:
+        index = bitfield.index(True, index + 1)
+        nrandom -= 1
+
+    return index
+
+
+class PiecePicker:
+    def __init__(self, file):
+        self.file = file
+        self.endgame = False
+        # Endgame is checked again after every update, as new pieces may
+        # have become allowed or blocks may have been rejected since
+        self._endgame_checked = False
+        # Pick pieces in order instead of randomly, for streaming
+        self.sequential = False
+        self.readahead = READAHEAD_PIECES
+        # piece index -> block index -> set of peers we requested it from
+        self.pending = {}
+        # Requests made to more than one peer, by endgame or because a
+        # deadline passed. Whoever sends the block first wins, the other
+        # requests get cancelled
+        self.duplicates = set()
+        # piece index -> time.monotonic() by which we'd like to have it
+        self.deadlines = {}
+        # If set, only pieces in this bitfield are picked
+        self.allowed = None
+
+        self.priorities = bytearray([PRIORITY_NORMAL] * file.num_pieces)
+        # One bitfield per priority level, so the picker can mask the
+        # pieces a peer has instead of looking at the priority of each
+        self.masks = []
+        for _ in range(PRIORITY_MAX + 1):
+            mask = bitarray(file.num_pieces * '0', endian="big")
+            mask.fill()
+            self.masks.append(mask)
+        self.masks[PRIORITY_NORMAL][:file.num_pieces] = True
+
+    def set_piece_priority(self, index, priority):
+        if not PRIORITY_SKIP <= priority <= PRIORITY_MAX:
+            raise ValueError("invalid priority: %d" % priority)
+        self.masks[self.priorities[index]][index] = False
+        self.masks[priority][index] = True
+        self.priorities[index] = priority
+        if priority == PRIORITY_SKIP:
+            self.deadlines.pop(index, None)
+
+    def set_range_priority(self, offset, length, priority):
+        """ Set the priority of every piece overlapping a byte range of the
+            payload, e.g. one file of a multi-file torrent """
+        if length == 0:
+            return
+        first = offset // self.file.piece_size
+        last = (offset + length - 1) // self.file.piece_size
+        for index in range(first, last + 1):
+            self.set_piece_priority(index, priority)
+
+    def set_deadline(self, index, deadline):
+        if self.file.pieces[index].verified:
+            return
+        if index not in self.deadlines or deadline < self.deadlines[index]:
+            self.deadlines[index] = deadline
+
+    def _read_ahead(self, offset):
+        now = time.monotonic()
+        first = offset // self.file.piece_size
+        last = min(first + self.readahead, self.file.num_pieces)
+
+        # The reader seeked past these
+        for index in [i for i in self.deadlines if i < first]:
+            del self.deadlines[index]
+
+        for i, index in enumerate(range(first, last)):
+            if self.priorities[index] != PRIORITY_SKIP:
+                self.set_deadline(index, now + (i + 1) * DEADLINE_STEP)
+
+    def finished(self):
+        """ Whether every piece we want is verified """
+        done = self.masks[PRIORITY_SKIP] | self.file.get_bitfield()
+        return done.count() == self.file.num_pieces
+
+    def update(self, peers):
+        """ Rebuild the outstanding requests from the peers' state """
+        self.pending = {}
+        self.duplicates = set()
+        for peer in peers:
+            for request in peer.state["out_requests"]:
+                self._add_pending(peer, request)
+        self._endgame_checked = False
+        self.update_deadlines()
+
+    def update_deadlines(self):
+        """ Forget the deadlines of verified pieces, and set them for the
+            pieces just ahead of File.read """
+        for index in [i for i in self.deadlines
+                      if self.file.pieces[i].verified]:
+            del self.deadlines[index]
+        if self.file.reader_offset is not None:
+            self._read_ahead(self.file.reader_offset)
+
+    def _add_pending(self, peer, request):
+        blocks = self.pending.setdefault(request.index, {})
+        peers = blocks.setdefault(request.begin // BLOCKSIZE, set())
+        peers.add(peer)
+        if len(peers) > 1:
+            self.duplicates.add(request)
+
+    def _make_request(self, peer, index, block_idx):
+        length = self.file.pieces[index].get_block_length(block_idx)
+        request = Request(index, block_idx * BLOCKSIZE, length)
+        self._add_pending(peer, request)
+        return request
+
+    def _check_endgame(self):
+        # Endgame starts once every block we still miss has been requested.
+        # That includes pieces not in allowed: a worker that requested all
+        # of its lease isn't at the end of the download
+        for index, piece in enumerate(self.file.pieces):
+            if piece.verified or self.priorities[index] == PRIORITY_SKIP:
+                continue
+            blocks = self.pending.get(index, {})
+            for block_idx in piece.block_progress.search(0):
+                if block_idx not in blocks:
+                    return False
+        return True
+
+    def _pick_free_block(self, peer, index):
+        blocks = self.pending.get(index, {})
+        free = [i for i in self.file.pieces[index].block_progress.search(0)
+                if i not in blocks]
+        if not free:
+            return None
+        block_idx = free[0] if self.sequential else random.choice(free)
+        return self._make_request(peer, index, block_idx)
+
+    def _duplicate_candidates(self, peer, index):
+        progress = self.file.pieces[index].block_progress
+        return [(index, block_idx)
+                for block_idx, peers in self.pending.get(index, {}).items()
+                if peer not in peers and len(peers) < ENDGAME_DUPLICATES
+                and not progress[block_idx]]
+
+    def _pick_deadline(self, peer, want_pieces):
+        now = time.monotonic()
+        for deadline, index in sorted([(d, i) for i, d
+                                       in self.deadlines.items()]):
+            if not want_pieces[index]:
+                continue
+            request = self._pick_free_block(peer, index)
+            if request is not None:
+                return request
+            # Overdue, so race the peers we already asked
+            if deadline < now:
+                candidates = self._duplicate_candidates(peer, index)
+                if candidates:
+                    return self._make_request(peer, *candidates[0])
+
+        return None
+
+    def _by_priority(self, want_pieces):
+        """ Yields the pieces in want_pieces, highest priority first """
+        for priority in range(PRIORITY_MAX, PRIORITY_SKIP, -1):
+            candidates = want_pieces & self.masks[priority]
+            while candidates.any():
+                if self.sequential:
+                    index = candidates.index(True)
+                else:
+                    index = random_set_bit(candidates)
+                candidates[index] = False
+                yield index
+
+    def _pick_new(self, peer, want_pieces):
+        request = self._pick_deadline(peer, want_pieces)
+        if request is not None:
+            return request
+
+        for index in self._by_priority(want_pieces):
+            request = self._pick_free_block(peer, index)
+            if request is not None:
+                return request
+
+        return None
+
+    def pick_pieces(self, want_pieces, count):
+        """ Up to count whole pieces out of want_pieces, in the order we'd
+            like to have them """
+        want_pieces = want_pieces.copy()
+        picked = []
+        for (_, index) in sorted([(d, i) for i, d in self.deadlines.items()]):
+            if len(picked) == count:
+                return picked
+            if want_pieces[index]:
+                want_pieces[index] = False
+                picked.append(index)
+
+        for index in self._by_priority(want_pieces):
+            if len(picked) == count:
+                break
+            picked.append(index)
+
+        return picked
+
+    def _pick_duplicate(self, peer, want_pieces):
+        candidates = []
+        for index in self.pending:
+            if want_pieces[index]:
+                candidates += self._duplicate_candidates(peer, index)
+
+        if not candidates:
+            return None
+        return self._make_request(peer, *random.choice(candidates))
+
+    def next_request(self, peer, want_pieces):
+        """ Pick a block to request from peer, or None if there's nothing
+            left worth asking it for """
+        if self.allowed is not None:
+            want_pieces = want_pieces & self.allowed
+
+        request = self._pick_new(peer, want_pieces)
+        if request is not None:
+            return request
+
+        if not self._endgame_checked:
+            endgame = self._check_endgame()
+            if endgame and not self.endgame:
+                print("Entering endgame mode")
+            self.endgame = endgame
+            self._endgame_checked = True
+
+        if self.endgame:
+            return self._pick_duplicate(peer, want_pieces)
+
+        return None
@@ -1,41 +1,103 @@
+import base64
+import errno
 import hashlib
+import os
 import random
 import selectors
 import socket as Socket
 import struct
+import sys
+import time
+import urllib.parse
 from bencode import bdecode, bencode
-from peer import Peer, Request
+from dht import DHTNode, DEFAULT_BOOTSTRAP
+from metadata import MetadataFetcher
+from peer import Peer, PEX_INTERVAL, PEX_MAX_PEERS
+from picker import PiecePicker, PRIORITY_NORMAL
 from tracker import Tracker
-from file import File, BLOCKSIZE
+from file import File
 
 BUFFER_SIZE = 4096
+MAX_OUT_REQUESTS = 20
+MAX_PEERS = 30
+# Don't open too many connections at once
+CONNECTS_PER_LOOP = 2
+HANDSHAKE_LENGTH = 1 + 19 + 8 + 20 + 20
+# Give up on connections that didn't complete the handshake in time
+HANDSHAKE_TIMEOUT = 10
+# Don't queue more blocks for a peer while this much is waiting to be sent
+MAX_WRITE_BUFFER = 4 * 16 * 1024
+# Stop learning about new peers once we know this many we could connect to
+MAX_SWARM = 1000
+# Addresses we couldn't connect to are tried again after this many seconds,
+# doubling every time, and forgotten after MAX_CONNECT_FAILURES tries
+RETRY_BACKOFF = 30
+MAX_CONNECT_FAILURES = 5
+# Look for peers on the DHT, and announce ourselves there, this often. Sooner
+# if we run out of peers to try
+DHT_INTERVAL = 15 * 60
+DHT_RETRY = 30
 
 ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-PEER_ID = str.encode("-PY0000-" +
-                     "".join([random.choice(ALPHABET) for _ in range(12)]))
+
+
+def make_peer_id(prefix=b"-PY0000-"):
+    """ prefix, usually the client id, followed by random characters """
+    return prefix + str.encode("".join([random.choice(ALPHABET)
+                                        for _ in range(20 - len(prefix))]))
+
+
+PEER_ID = make_peer_id()
 assert len(PEER_ID) == 20
 
-# TODO put in some sort of utils module?
-def random_set_bit(bitfield):
-    nset = bitfield.count()
-    nrandom = random.randrange(nset)
+# We support the extension protocol (BEP 10) and the Fast extension (BEP 6)
+RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0x04])
+
+
+def parse_magnet(uri):
+    """ Returns the info hash, display name and trackers of a magnet link """
+    res = urllib.parse.urlparse(uri)
+    if res.scheme != "magnet":
+        raise ValueError("not a magnet link: %s" % uri)
+    params = urllib.parse.parse_qs(res.query)
+
+    info_hash = None
+    for urn in params.get("xt", []):
+        if not urn.startswith("urn:btih:"):
+            continue
+        digest = urn[len("urn:btih:"):]
+        try:
+            if len(digest) == 40:
+                info_hash = bytes.fromhex(digest).hex()
+            elif len(digest) == 32:
+                info_hash = base64.b32decode(digest.upper()).hex()
+        except ValueError as e:
+            raise ValueError("invalid info hash in magnet link") from e
+    if info_hash is None:
+        raise ValueError("no bittorrent info hash in magnet link")
 
-    index = bitfield.index(True)
-    while nrandom > 0:
-        index = bitfield.index(True, index + 1)
-        nrandom -= 1
+    name = params.get("dn", [None])[0]
+    return info_hash, name, params.get("tr", [])
 
-    return index
 
 #TODO PeerMgr class?
 def send_handshake(socket, info_hash, peer_id):
     handshake = struct.pack("!B19s8s20s20s", 19, b"BitTorrent protocol",
-                            8*b'\0', bytes.fromhex(info_hash), peer_id)
+                            RESERVED, bytes.fromhex(info_hash), peer_id)
 
     socket.send(handshake)
 
 def recv_handshake(socket, info_hash):
-    response = socket.recv(1 + 19 + 8 + 20 + 20)
+    response = b""
+    while len(response) < HANDSHAKE_LENGTH:
+        data = socket.recv(HANDSHAKE_LENGTH - len(response))
+        if not data:
+            break
+        response += data
+
+    return parse_handshake(response, info_hash)
+
+def parse_handshake(response, info_hash):
     try:
         response = struct.unpack("!B19s8s20s20s", response)
     except struct.error as e:
@@ -47,25 +109,71 @@ def recv_handshake(socket, info_hash):
     if response[3] != bytes.fromhex(info_hash):
         raise RuntimeError("wrong info hash: %s" % hex(response[3]))
 
-    return response[4]
+    return response[2], response[4]
+
+
+class Handshake:
+    """ A connection the main loop is still exchanging handshakes on """
+    def __init__(self, socket, address, incoming):
+        self.socket = socket
+        self.address = address
+        self.incoming = incoming
+        self.sent = False
+        self.buffer = b""
+        self.started = time.monotonic()
+
 
 class Torrent:
-    def __init__(self, filename):
+    def __init__(self, filename=None, magnet=None):
         self.info_hash = None
+        self.metainfo = None
+        self.metadata = None  # the info dictionary, bencoded
         self.trackers = []
         self.swarm = set()
+        # Addresses we couldn't connect to -> (how many times in a row,
+        # when to try again)
+        self.failed = {}
         self.peers = set()
+        self.handshakes = set()
+        self.peer_id = PEER_ID
+        self.running = True
+        self.listener = None
+        self.port = None
         self._downloaded = 0
         self._uploaded = 0
         self.file = None
+        self.picker = None
+        self.files = []  # (path, offset, length) for every file in the payload
+        self.file_priorities = []
+        self.streaming = False
+        self.dht = None
+        self.dht_nodes = []  # bootstrap nodes from the torrent file
+        self._dht_lookup = None
+        self._dht_last = None
+        # How many loop iterations we did, and how long we spent working in
+        # them, as opposed to waiting on the sockets
+        self.stats = {"loops": 0, "busy": 0.0, "max_busy": 0.0}
+
+        if magnet is not None:
+            # We'll get the info dictionary from our peers (BEP 9)
+            self.info_hash, _, urls = parse_magnet(magnet)
+            for url in urls:
+                try:
+                    self.trackers.append(Tracker(url))
+                except ValueError as e:
+                    print("Skipping tracker %s: %s" % (url, e))
+            self.fetcher = MetadataFetcher(self.info_hash)
+            return
 
         with open(filename, "rb") as tr_file:
             contents = tr_file.read()
         try:
             self.metainfo = bdecode(contents)  # Do we need to keep this?
             self.parse_metainfo(self.metainfo)
-        except (ValueError, KeyError, UnicodeError) as e:
+        except (ValueError, KeyError, UnicodeError, TypeError,
+                AttributeError) as e:
             raise ValueError("invalid or corrupt torrent file") from e
+        self.fetcher = None
 
     def parse_metainfo(self, metainfo):
         sha = hashlib.sha1(bencode(metainfo[b"info"]))
@@ -80,12 +188,72 @@ class Torrent:
             url = self.metainfo[b"announce"].decode()
             self.trackers = [Tracker(url)]
         else:
-            pass
-            #raise ValueError("no tracker in torrent file")
+            print("No tracker in torrent file, relying on the DHT and PEX")
+        for (host, port) in metainfo.get(b"nodes", []):
+            if type(port) is not int or not 0 < port < 65536:
+                raise ValueError("invalid DHT node port %r" % (port,))
+            self.dht_nodes.append((host.decode(), port))
+
+        self.parse_info(self.metainfo[b"info"])
+
+    def parse_info(self, info):
+        self.metadata = bencode(info)
+        if b"files" in info:
+            # TODO Multi-file payloads are stored as one concatenated file,
+            # we only keep the layout around for file priorities
+            offset = 0
+            for entry in info[b"files"]:
+                path = "/".join([part.decode() for part in entry[b"path"]])
+                self.files.append((path, offset, entry[b"length"]))
+                offset += entry[b"length"]
+            length = offset
+        else:
+            length = info[b"length"]
+            self.files = [(info[b"name"].decode(), 0, length)]
+        self.file_priorities = [PRIORITY_NORMAL] * len(self.files)
 
-        info = self.metainfo[b"info"]
-        self.file = File(info[b"name"], info[b"length"],
+        self.file = File(info[b"name"], length,
                          info[b"piece length"], info[b"pieces"])
+        self.picker = PiecePicker(self.file)
+        self.picker.sequential = self.streaming
+
+    def set_metadata(self, metadata):
+        """ Start the download once we fetched the info dictionary, which
+            should already be checked against the info hash, like
+            MetadataFetcher.result does """
+        try:
+            info = bdecode(metadata)
+            self.metainfo = {b"info": info}
+            self.parse_info(info)
+        except (ValueError, KeyError, UnicodeError) as e:
+            raise ValueError("invalid or corrupt metadata") from e
+
+        for peer in self.peers:
+            peer.metadata = self.metadata
+            peer.set_file(self.file)
+
+    def set_streaming(self, streaming=True):
+        """ Download the pieces in order, for playing the payload while it
+            downloads. Pieces just ahead of File.read always come first """
+        self.streaming = streaming
+        if self.picker is not None:
+            self.picker.sequential = streaming
+
+    def set_file_priority(self, index, priority):
+        (_, offset, length) = self.files[index]
+        self.file_priorities[index] = priority
+        self.picker.set_range_priority(offset, length, priority)
+        if length == 0:
+            return
+
+        # Pieces on the edges are shared with neighbouring files, and get the
+        # highest priority of all files they overlap with
+        piece_size = self.file.piece_size
+        for piece in (offset // piece_size, (offset + length - 1) // piece_size):
+            start, end = piece * piece_size, (piece + 1) * piece_size
+            self.picker.set_piece_priority(piece, max(
+                [p for (_, o, l), p in zip(self.files, self.file_priorities)
+                 if o < end and o + l > start]))
 
     def get_downloaded(self):
         return self._downloaded + sum([p.downloaded for p in self.peers])
@@ -93,11 +261,32 @@ class Torrent:
     def get_uploaded(self):
         return self._uploaded + sum([p.uploaded for p in self.peers])
 
+    def _add_peer(self, socket, address, peer_id, reserved):
+        if peer_id == self.peer_id or \
+           peer_id in [peer.peer_id for peer in self.peers]:
+            socket.close()
+            raise RuntimeError("already connected to peer %r" % (address,))
+
+        new_peer = Peer(socket, address, peer_id, self.file, reserved)
+        new_peer.metadata = self.metadata
+        new_peer.our_port = self.port
+        self.peers.add(new_peer)
+        return new_peer
+
     def connect(self, address, expected_peer_id=None):
         socket = Socket.create_connection(address, timeout=5) # FIXME...
 
-        send_handshake(socket, self.info_hash, PEER_ID)
-        recv_peer_id = recv_handshake(socket, self.info_hash)
+        # We'd wait for our own handshake until the timeout
+        if socket.getpeername()[:2] == (socket.getsockname()[0], self.port):
+            socket.close()
+            raise RuntimeError("can't connect to ourselves")
+
+        try:
+            send_handshake(socket, self.info_hash, self.peer_id)
+            reserved, recv_peer_id = recv_handshake(socket, self.info_hash)
+        except (OSError, RuntimeError):
+            socket.close()
+            raise
 
         if expected_peer_id and expected_peer_id != recv_peer_id:
             socket.close()
@@ -105,37 +294,309 @@ class Torrent:
                                "what we got from the tracker: %s" %
                                (recv_peer_id, address, expected_peer_id))
 
-        new_peer = Peer(socket, address, recv_peer_id, self.file)
-        self.peers.add(new_peer)
-        return new_peer
+        return self._add_peer(socket, address, recv_peer_id, reserved)
+
+    def listen(self, port=0, host=""):
+        """ Accept incoming connections, returns the port we listen on """
+        self.listener = Socket.create_server((host, port))
+        self.port = self.listener.getsockname()[1]
+        return self.port
 
-    def mainloop(self):
-#        ret = self.trackers[0].announce(self, PEER_ID, event="started",numwant=20)
-#        self.swarm |= set(ret["peers"])
-        self.swarm = {("127.0.0.1", 58427)}
+    def _start_connect(self, address, selector):
+        socket = Socket.socket(Socket.AF_INET, Socket.SOCK_STREAM)
+        socket.setblocking(False)
+        err = socket.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS):
+            socket.close()
+            raise OSError(err, os.strerror(err))
+
+        handshake = Handshake(socket, address, incoming=False)
+        self.handshakes.add(handshake)
+        # Writable once connected
+        selector.register(socket, selectors.EVENT_WRITE, handshake)
+
+    def _accept(self, selector):
+        socket, address = self.listener.accept()
+        socket.setblocking(False)
+
+        handshake = Handshake(socket, address, incoming=True)
+        self.handshakes.add(handshake)
+        selector.register(socket, selectors.EVENT_READ, handshake)
+
+    def _drop_handshake(self, handshake, selector):
+        self.handshakes.discard(handshake)
+        selector.unregister(handshake.socket)
+        handshake.socket.close()
+        if not handshake.incoming:
+            self._connect_failed(handshake.address)
+
+    def _connect_failed(self, address):
+        failures = self.failed.get(address, (0, 0))[0] + 1
+        if failures >= MAX_CONNECT_FAILURES:
+            print("Giving up on peer %r" % (address,))
+            self.failed.pop(address, None)
+            self.swarm.discard(address)
+        else:
+            self.failed[address] = (failures, time.monotonic() +
+                                    RETRY_BACKOFF * 2 ** (failures - 1))
+
+    def _backing_off(self):
+        """ Addresses that failed recently, and shouldn't be tried yet """
+        now = time.monotonic()
+        return {address for address, (_, retry) in self.failed.items()
+                if retry > now}
+
+    def _add_to_swarm(self, addresses):
+        # Addresses that failed are forgotten eventually, so they don't count
+        for address in addresses:
+            if len(self.swarm) - len(self.failed) >= MAX_SWARM:
+                break
+            self.swarm.add(address)
+
+    def _advance_handshake(self, handshake, mask, selector):
+        socket = handshake.socket
+
+        if not handshake.incoming and not handshake.sent:
+            err = socket.getsockopt(Socket.SOL_SOCKET, Socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+            # We'd wait for our own handshake until the timeout
+            if socket.getpeername()[:2] == (socket.getsockname()[0],
+                                            self.port):
+                raise RuntimeError("can't connect to ourselves")
+            send_handshake(socket, self.info_hash, self.peer_id)
+            handshake.sent = True
+            selector.modify(socket, selectors.EVENT_READ, handshake)
+            return
+
+        if not mask & selectors.EVENT_READ:
+            return
+        data = socket.recv(HANDSHAKE_LENGTH - len(handshake.buffer))
+        if not data:
+            raise RuntimeError("connection closed during handshake")
+        handshake.buffer += data
+        if len(handshake.buffer) < HANDSHAKE_LENGTH:
+            return
+
+        reserved, peer_id = parse_handshake(handshake.buffer, self.info_hash)
+        if handshake.incoming:
+            if len(self.peers) >= MAX_PEERS:
+                raise RuntimeError("too many peers")
+            send_handshake(socket, self.info_hash, self.peer_id)
+
+        # Raises for duplicates, while we still track the handshake
+        peer = self._add_peer(socket, handshake.address, peer_id, reserved)
+        self.handshakes.remove(handshake)
+        selector.unregister(socket)
+        socket.settimeout(5)  # FIXME...
+        peer.incoming = handshake.incoming
+        if not handshake.incoming:
+            self.failed.pop(handshake.address, None)
+        self._greet_peer(peer, selector)
+
+    def _update_handshakes(self, events, selector):
+        for key, mask in events:
+            if not isinstance(key.data, Handshake):
+                continue
+            handshake = key.data
+            try:
+                self._advance_handshake(handshake, mask, selector)
+            except (OSError, RuntimeError) as e:
+                print("Handshake with %r failed: %s" % (handshake.address, e))
+                if handshake in self.handshakes:
+                    self._drop_handshake(handshake, selector)
+
+        now = time.monotonic()
+        for handshake in list(self.handshakes):
+            if now - handshake.started > HANDSHAKE_TIMEOUT:
+                print("Handshake with %r timed out" % (handshake.address,))
+                self._drop_handshake(handshake, selector)
+
+    def _greet_peer(self, peer, selector):
+        peer.send_bitfield()
+        if peer.extended:
+            peer.send_extended_handshake()
+        selector.register(peer.socket, selectors.EVENT_READ, peer)
+
+    def _fetch_metadata(self):
+        for peer in self.peers:
+            if self.file is not None:
+                peer.state["metadata_pieces"] = []
+                continue
+
+            if peer.metadata_size is not None:
+                self.fetcher.set_size(peer, peer.metadata_size)
+            for (piece, data) in peer.state["metadata_pieces"]:
+                if data is None:
+                    self.fetcher.piece_rejected(peer, piece)
+                else:
+                    self.fetcher.piece_received(peer, piece, data)
+            peer.state["metadata_pieces"] = []
 
-        selector = selectors.DefaultSelector()
+            if b"ut_metadata" in peer.extensions:
+                piece = self.fetcher.next_request(peer)
+                if piece is not None:
+                    peer.request_metadata(piece)
 
-        # connect to some peers until we're at 10 or so FIXME
-        for addr in random.sample(self.swarm, 1):
+        if self.file is None and self.fetcher.done():
+            try:
+                metadata = self.fetcher.result()
+            except ValueError as e:
+                print("Invalid metadata from peers: %s" % e)
+                for peer in self.fetcher.banned:
+                    peer.dead = True
+                return
+            self.set_metadata(metadata)
+            print("Got the metadata, starting download")
+
+    def _listen_addresses(self):
+        """ Where our peers accept connections, as far as we know. For
+            incoming connections that's only known if they told us """
+        addresses = set()
+        for peer in self.peers:
+            if peer.listen_port is not None:
+                addresses.add((peer.address[0], peer.listen_port))
+            elif not peer.incoming:
+                addresses.add(peer.address)
+        return addresses
+
+    def _connect_peers(self, selector):
+        connected = {peer.address for peer in self.peers}
+        connected |= self._listen_addresses()
+        connected |= {handshake.address for handshake in self.handshakes}
+        candidates = list(self.swarm - connected - self._backing_off())
+        wanted = min(MAX_PEERS - len(self.peers) - len(self.handshakes),
+                     CONNECTS_PER_LOOP)
+        if wanted <= 0 or not candidates:
+            return
+
+        for addr in random.sample(candidates, min(wanted, len(candidates))):
             try:
-                peer = self.connect(addr)
-                peer.send_bitfield()
-                selector.register(peer.socket, selectors.EVENT_READ, peer)
+                self._start_connect(addr, selector)
             except OSError as e:
                 print(e)
                 print("Couldn't connect to peer... %r" % (addr,))
+                self._connect_failed(addr)
+
+    def _exchange_peers(self):
+        # Merge what our peers told us into the swarm. A peer dropping
+        # someone doesn't mean we can't reach them, so we ignore those
+        for peer in self.peers:
+            self._add_to_swarm(peer.state["pex_added"])
+            peer.state["pex_added"] = []
+            peer.state["pex_dropped"] = []
+
+        now = time.monotonic()
+        connected = self._listen_addresses()
+        for peer in self.peers:
+            if b"ut_pex" not in peer.extensions:
+                continue
+            if peer.pex_sent is not None and now - peer.pex_sent < PEX_INTERVAL:
+                continue
+            others = connected - {peer.address} - \
+                     {(peer.address[0], peer.listen_port)}
+            added = list(others - peer.pex_known)[:PEX_MAX_PEERS]
+            dropped = list(peer.pex_known - others)[:PEX_MAX_PEERS]
+            if added or dropped:
+                peer.send_pex(added, dropped)
+
+    def use_dht(self, dht, bootstrap=()):
+        """ Find peers with dht, a DHTNode, as well """
+        self.dht = dht
+        self._dht_lookup = dht.bootstrap(list(bootstrap) + self.dht_nodes)
+
+    def _dht_peers(self, lookup):
+        print("DHT lookup found %d peers in %.1f s, %d messages" % (
+            len(lookup.peers), lookup.latency, lookup.messages))
+        self._add_to_swarm(lookup.peers)
+
+    def _update_dht(self):
+        if self.dht is None:
+            return
+        self.dht.tick()
+        if self._dht_lookup is not None and not self._dht_lookup.done:
+            return
+
+        now = time.monotonic()
+        untried = self.swarm - self._backing_off() - self._listen_addresses()
+        interval = DHT_INTERVAL if untried else DHT_RETRY
+        if self._dht_last is not None and now - self._dht_last < interval:
+            return
+        self._dht_last = now
+        self._dht_lookup = self.dht.get_peers(bytes.fromhex(self.info_hash),
+                                              announce_port=self.port,
+                                              callback=self._dht_peers)
+
+    def announce_pieces(self, indices):
+        """ Called with the pieces we just verified """
+        for peer in self.peers:
+            peer.send_haves(indices)
+
+    def _serve_peers(self):
+        for peer in self.peers:
+            # TODO Real choking algorithm, for now anyone interested gets in
+            if peer.state["is_interested"]:
+                peer.unchoke()
+
+            while peer.state["in_requests"] and \
+                  len(peer.write_buffer) < MAX_WRITE_BUFFER:
+                peer.send_block(peer.state["in_requests"].pop(0))
+
+    def _request_blocks(self):
+        our_pieces = self.file.get_bitfield()
+        self.picker.update(self.peers)
+        for peer in self.peers:
+            his_pieces = peer.state["has_pieces"]
+            want_pieces = his_pieces & ~our_pieces
+            if not want_pieces.any():
+                peer.not_interested()
+                continue # they have nothing we want
+
+            # tell them we're interested
+            peer.interested()
+
+            # wait till unchoke
+            if peer.state["is_choking"]:
+                continue
+
+            # keep the request pipeline to this peer filled
+            while len(peer.state["out_requests"]) < MAX_OUT_REQUESTS:
+                request = self.picker.next_request(peer, want_pieces)
+                if request is None:
+                    break
+                print("Request %r" % (request,))
+                peer.request(request)
 
-        counter = 1
-
-        while True:
-            for peer in self.peers:
+    def mainloop(self, seed=False, selector=None):
+        """ Download from the swarm. Returns when we have every piece we
+            want, unless seed is set, in which case it keeps on serving until
+            running is cleared. Callables registered with selector are called
+            when their file object is ready """
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        if self.listener is not None:
+            selector.register(self.listener, selectors.EVENT_READ, None)
+        if self.dht is not None:
+            selector.register(self.dht.socket, selectors.EVENT_READ,
+                              self.dht.handle_read)
+
+        done = False
+
+        while self.running:
+            self._connect_peers(selector)
+
+            for peer in list(self.peers):
                 if peer.dead:
                     print("Deleting peer %r" % peer)
                     selector.unregister(peer.socket)
-                    peer.socket.shutdown()
+                    try:
+                        peer.socket.shutdown(Socket.SHUT_RDWR)
+                    except OSError:
+                        pass  # Already disconnected
                     peer.socket.close()
                     self.peers.remove(peer)
+                    if self.fetcher is not None:
+                        self.fetcher.peer_gone(peer)
                     self._downloaded += peer.downloaded
                     self._uploaded += peer.uploaded
                 elif peer.write_buffer:
@@ -145,86 +606,112 @@ class Torrent:
                     selector.modify(peer.socket, selectors.EVENT_READ, peer)
 
             events = selector.select(2) # FIXME LOL
+            busy_start = time.perf_counter()
 
+            self._update_handshakes(events, selector)
             for key, mask in events:
                 peer = key.data
 
+                if peer is None:
+                    try:
+                        self._accept(selector)
+                    except OSError as e:
+                        print("Couldn't accept peer: %s" % e)
+                    continue
+                if callable(peer):
+                    peer()
+                    continue
+                if not isinstance(peer, Peer):
+                    continue
+
                 if mask & selectors.EVENT_READ:
-                    buffer = peer.socket.recv(BUFFER_SIZE)
+                    try:
+                        buffer = peer.socket.recv(BUFFER_SIZE)
+                    except OSError:
+                        buffer = b""
                     if len(buffer) == 0:
                         peer.dead = True
                     peer.downloaded += len(buffer)
                     peer.read_messages(buffer)
 
-                if mask & selectors.EVENT_WRITE:
-                    sent = peer.socket.send(peer.write_buffer)
+                if mask & selectors.EVENT_WRITE and not peer.dead:
+                    try:
+                        sent = peer.socket.send(peer.write_buffer)
+                    except OSError:
+                        sent = 0
                     if sent == 0:
                         peer.dead = True
                     peer.uploaded += sent
                     peer.write_buffer = peer.write_buffer[sent:]
 
-            # send have message for every newly completed piece
-            new_haves = set()
-            for peer in self.peers:
-                while peer.state["completed_requests"]:
-                    (index, _, _) = peer.state["completed_requests"].pop()
-                    if self.file.pieces[index].verified:
-                        new_haves.add(index)
+            self._fetch_metadata()
+            self._exchange_peers()
+            self._update_dht()
+            if self.file is not None:
+                done = self._update_pieces(done)
+                if done and not seed:
+                    break
 
-            for peer in self.peers:
-                for index in new_haves:
-                    peer.send_have(index)
-                    peer.send_bitfield()
+            busy = time.perf_counter() - busy_start
+            self.stats["loops"] += 1
+            self.stats["busy"] += busy
+            self.stats["max_busy"] = max(self.stats["max_busy"], busy)
 
-            our_pieces = self.file.get_bitfield()
-            if self.file.num_pieces == our_pieces.count():
-                print("Were done!!")
-                break
+            # eat sleep rave repeat
 
+    def _update_pieces(self, done):
+        # send have message for every newly completed piece, and cancel
+        # duplicated requests at every other peer we asked for the block
+        new_haves = set()
+        for peer in self.peers:
+            while peer.state["completed_requests"]:
+                request = peer.state["completed_requests"].pop()
+                if request in self.picker.duplicates:
+                    for other in self.peers:
+                        if request in other.state["out_requests"]:
+                            other.send_cancel(request)
+                if self.file.pieces[request.index].verified:
+                    new_haves.add(request.index)
+
+        if new_haves:
+            self.announce_pieces(sorted(new_haves))
+
+        self._serve_peers()
+
+        if self.picker.finished():
+            if not done:
+                print("Were done!!")
             for peer in self.peers:
-                his_pieces = peer.state["has_pieces"]
-                want_pieces = his_pieces & ~our_pieces
-                if not any(want_pieces):
-                    continue # they have nothing we want
-
-                # tell them we're interested
-                peer.interested()
-
-                # wait till unchoke
-                if peer.state["is_choking"]:
-                    continue
-
-                # send requests for rarest pepes
-                if len(peer.state["out_requests"]) > 20: # FIXME :p
-                    continue
-
-                ctr = 0
-                request = None # FIXME...
-                while request is None or request in peer.state["out_requests"] and ctr < 20:
-                    piece_idx = random_set_bit(want_pieces)
-
-                    blocks_we_dont_have = ~self.file.pieces[piece_idx].block_progress
-                    block_idx = random_set_bit(blocks_we_dont_have)
+                peer.not_interested()
+            return True
 
-                    length = self.file.pieces[piece_idx].get_block_length(block_idx)
-                    request = Request(piece_idx, block_idx*BLOCKSIZE, length)
-                    ctr += 1
-
-                print("Request %d: %r" % (counter, request))
-                peer.request(request)
-                counter += 1
-
-            # eat sleep rave repeat
+        self._request_blocks()
+        return False
 
 
 if __name__ == "__main__":
-    arch = Torrent("arch.torrent")
-    pic = Torrent("pic.torrent")
-    ubuntu = Torrent("ubuntu.torrent")
-    payload = Torrent("payload.torrent")
-    # fedora = Torrent("fedora.torrent")
-    # d = Torrent("/tmp/debian.torrent")
-    h1 = "50bceef91cb7ce8933274b6e6016454581f77a19"
-    h2 = "8baffd307f47f506769a3e136fc5921e90bde158"
-    h3 = "382b3f154c9c8d478f87d30d625a8989f420b965"
-    f = File("kasper.txt", 24, 9, bytes.fromhex(h1 + h2 + h3))
+    # python torrent.py <torrent file or magnet link> [host:port ...]
+    if sys.argv[1].startswith("magnet:"):
+        torrent = Torrent(magnet=sys.argv[1])
+    else:
+        torrent = Torrent(sys.argv[1])
+
+    for arg in sys.argv[2:]:
+        (host, port) = arg.rsplit(":", 1)
+        torrent.swarm.add((host, int(port)))
+
+    # Before announcing, so the tracker hands out the port we listen on
+    torrent.listen()
+    if not torrent.swarm and torrent.file is not None:
+        for tracker in torrent.trackers:
+            try:
+                ret = tracker.announce(torrent, torrent.peer_id,
+                                       event="started", numwant=20)
+                torrent._add_to_swarm(ret["peers"])
+                break
+            except RuntimeError as e:
+                print(e)
+
+    if not torrent.swarm:
+        torrent.use_dht(DHTNode(), DEFAULT_BOOTSTRAP)
+    torrent.mainloop()
@@ -29,6 +29,17 @@ def __decode_peers_binary(peerlist):
     return peers
 
 
+def encode_peers(peers):
+    """ Compact binary peer list, IPv4 only """
+    peerlist = b""
+    for (addr, port) in peers:
+        try:
+            peerlist += socket.inet_aton(addr) + struct.pack("!H", port)
+        except OSError:
+            pass  # Not an IPv4 address
+    return peerlist
+
+
 def decode_peers(peerlist):
     if type(peerlist) is list:
         return __decode_peers_dictionary(peerlist)
@@ -59,11 +70,13 @@ class Tracker:
         if event and event not in ("started", "stopped", "completed"):
             raise ValueError("event must be one of"
                              "started, stopped or completed")
+        if torrent.port is None:
+            raise ValueError("torrent should listen before announcing")
 
         values = {
             "info_hash": bytes.fromhex(torrent.info_hash),
             "peer_id": peer_id,
-            "port": 6880, # FIXME
+            "port": torrent.port,
             "uploaded": torrent.get_uploaded(),
             "downloaded": torrent.get_downloaded(),
             "left": torrent.file.filesize,
@@ -0,0 +1,270 @@
+""" Sharding peer connections over several processes
+
+Every worker process runs its own main loop with its own peers, on its own
+mapping of the same file on disk. The coordinator owns the piece picker and
+the verified bitfield. It leases whole pieces to workers, so all blocks of a
+piece are downloaded, and hashed, by the same worker. Only small control
+messages go over the pipes between them:
+
+    worker -> coordinator   ("want", availability, count)
+                            ("verified", indices)
+                            ("stats", stats, downloaded, uploaded)
+    coordinator -> worker   ("lease", indices)
+                            ("have", indices)
+                            ("connect", addresses)
+                            ("stop",)
+"""
+import multiprocessing
+import multiprocessing.connection
+import selectors
+import signal
+import time
+from bitarray import bitarray
+from picker import ENDGAME_DUPLICATES
+from torrent import Torrent, make_peer_id
+
+# Workers ask for more pieces once they have fewer than LEASE_LOW_WATER to
+# work on, and get at most LEASE_SIZE at a time
+LEASE_SIZE = 8
+LEASE_LOW_WATER = 4
+# The coordinator answers every want. If it had nothing for us, don't ask
+# again for this many seconds
+WANT_INTERVAL = 0.2
+# Pieces leased longer ago than this may be handed out again
+LEASE_TIMEOUT = 30
+
+
+def _empty_bitfield(num_pieces):
+    bitfield = bitarray(num_pieces * '0', endian="big")
+    bitfield.fill()
+    return bitfield
+
+
+class WorkerTorrent(Torrent):
+    def __init__(self, info_hash, metadata, conn):
+        super().__init__(magnet="magnet:?xt=urn:btih:" + info_hash)
+        self.set_metadata(metadata)
+        # Pieces can be leased to more than one worker, and a bad peer at
+        # one mustn't overwrite what another one verified already
+        self.file.set_buffered()
+        self.conn = conn
+        self.picker.allowed = _empty_bitfield(self.file.num_pieces)
+        self._want_pending = False
+        self._last_empty = 0  # when the coordinator last had nothing for us
+
+    def read_control(self):
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            self.running = False
+            return
+
+        if message[0] == "lease":
+            self._want_pending = False
+            if not message[1]:
+                self._last_empty = time.monotonic()
+            for index in message[1]:
+                self.picker.allowed[index] = True
+        elif message[0] == "have":
+            indices = [i for i in message[1]
+                       if not self.file.pieces[i].verified]
+            for index in indices:
+                self.file.mark_verified(index)
+                self.picker.allowed[index] = False
+            # Another worker got these first
+            for peer in self.peers:
+                for request in list(peer.state["out_requests"]):
+                    if request.index in indices:
+                        peer.send_cancel(request)
+            # Don't tell the coordinator, it told us
+            Torrent.announce_pieces(self, indices)
+        elif message[0] == "connect":
+            self._add_to_swarm(message[1])
+        elif message[0] == "stop":
+            self.running = False
+
+    def announce_pieces(self, indices):
+        for index in indices:
+            self.picker.allowed[index] = False
+        self.conn.send(("verified", indices))
+        super().announce_pieces(indices)
+
+    def _want_leases(self):
+        if self._want_pending:
+            return
+        leased = (self.picker.allowed & ~self.file.get_bitfield()).count()
+        if leased >= LEASE_LOW_WATER or \
+           time.monotonic() - self._last_empty < WANT_INTERVAL:
+            return
+
+        available = _empty_bitfield(self.file.num_pieces)
+        for peer in self.peers:
+            available |= peer.state["has_pieces"]
+        available &= ~self.file.get_bitfield()
+        if not available.any():
+            return
+
+        self.conn.send(("want", available.tobytes(), LEASE_SIZE - leased))
+        self._want_pending = True
+
+    def _request_blocks(self):
+        self._want_leases()
+        super()._request_blocks()
+
+
+def _worker(info_hash, metadata, peer_id, streaming, listener, conn,
+            inherited):
+    # Forked with the coordinator's ends of the pipes, its handlers too.
+    # Holding on to those would keep other workers from seeing EOF
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for other in inherited:
+        other.close()
+
+    torrent = WorkerTorrent(info_hash, metadata, conn)
+    torrent.peer_id = peer_id
+    torrent.set_streaming(streaming)
+    if listener is not None:
+        # Every worker accepts on the same socket, the losers mustn't block
+        listener.setblocking(False)
+        torrent.listener = listener
+        torrent.port = listener.getsockname()[1]
+
+    selector = selectors.DefaultSelector()
+    selector.register(conn, selectors.EVENT_READ, torrent.read_control)
+    torrent.mainloop(seed=True, selector=selector)
+
+    conn.send(("stats", torrent.stats, torrent.get_downloaded(),
+               torrent.get_uploaded()))
+
+
+class Coordinator:
+    def __init__(self, torrent, num_workers):
+        if torrent.file is None:
+            raise ValueError("need the metadata before starting workers")
+        self.torrent = torrent
+        self.file = torrent.file
+        self.picker = torrent.picker
+        self.num_workers = num_workers
+        self.workers = []  # our end of each worker's pipe
+        self.processes = []
+        # piece index -> worker -> when it was leased
+        self.leases = {}
+
+    def _start(self):
+        ctx = multiprocessing.get_context("fork")
+        for index in range(self.num_workers):
+            (ours, theirs) = ctx.Pipe()
+            # Any id derived from ours could be another node's
+            peer_id = make_peer_id(self.torrent.peer_id[:8])
+            process = ctx.Process(target=_worker, daemon=True, args=(
+                self.torrent.info_hash, self.torrent.metadata, peer_id,
+                self.torrent.streaming, self.torrent.listener, theirs, self.workers + [ours]))
+            process.start()
+            theirs.close()
+            self.workers.append(ours)
+            self.processes.append(process)
+
+        verified = [i for i in range(self.file.num_pieces)
+                    if self.file.pieces[i].verified]
+        if verified:
+            for worker in self.workers:
+                worker.send(("have", verified))
+
+        addresses = list(self.torrent.swarm)
+        for index, worker in enumerate(self.workers):
+            worker.send(("connect", addresses[index::self.num_workers]))
+
+    def _lease(self, worker, available, count):
+        now = time.monotonic()
+        # Whoever streams reads from our mapping, the pieces just ahead of
+        # it go first
+        self.picker.update_deadlines()
+        bitfield = bitarray(endian="big")
+        bitfield.frombytes(available)
+        candidates = bitfield & ~self.file.get_bitfield()
+
+        free = candidates.copy()
+        for index, holders in self.leases.items():
+            if any([now - when < LEASE_TIMEOUT for when in holders.values()]):
+                free[index] = False
+        picked = self.picker.pick_pieces(free, count)
+
+        if not picked:
+            # Endgame, race the other workers for what's left
+            for index, holders in self.leases.items():
+                if worker in holders or len(holders) >= ENDGAME_DUPLICATES:
+                    candidates[index] = False
+            picked = self.picker.pick_pieces(candidates, count)
+
+        for index in picked:
+            self.leases.setdefault(index, {})[worker] = now
+        worker.send(("lease", picked))
+
+    def _verified(self, worker, indices):
+        for index in indices:
+            self.file.mark_verified(index)
+            self.leases.pop(index, None)
+
+        for other in self.workers:
+            if other is not worker:
+                other.send(("have", indices))
+
+    def _stop(self):
+        self.torrent.stats = {"loops": 0, "busy": 0.0, "max_busy": 0.0}
+        for worker in self.workers:
+            worker.send(("stop",))
+
+        for worker in self.workers:
+            while True:
+                try:
+                    message = worker.recv()
+                except EOFError:
+                    break
+                if message[0] == "stats":
+                    (_, stats, downloaded, uploaded) = message
+                    self.torrent.stats["loops"] += stats["loops"]
+                    self.torrent.stats["busy"] += stats["busy"]
+                    self.torrent.stats["max_busy"] = max(
+                        self.torrent.stats["max_busy"], stats["max_busy"])
+                    self.torrent._downloaded += downloaded
+                    self.torrent._uploaded += uploaded
+                    break
+
+        for process in self.processes:
+            process.join()
+
+    def _terminate(self, signum, frame):
+        raise SystemExit("terminated")
+
+    def run(self, seed=False):
+        """ Like Torrent.mainloop, but with the peers spread over workers """
+        # Make sure the workers go too if we're killed, or fail
+        previous = signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            self._run(seed)
+        finally:
+            signal.signal(signal.SIGTERM, previous)
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+
+    def _run(self, seed):
+        self._start()
+
+        while self.torrent.running:
+            for worker in multiprocessing.connection.wait(self.workers, 1):
+                try:
+                    message = worker.recv()
+                except EOFError:
+                    raise RuntimeError("worker died")
+                if message[0] == "want":
+                    self._lease(worker, message[1], message[2])
+                elif message[0] == "verified":
+                    self._verified(worker, message[1])
+
+            if not seed and self.picker.finished():
+                print("Were done!!")
+                break
+
+        self._stop()